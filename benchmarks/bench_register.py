@@ -0,0 +1,143 @@
+"""
+Benchmark the overhead of pyelastix around the Elastix executables:
+writing the images and parameters, processing the output of Elastix,
+and reading and splitting the results.
+
+The executables are replaced with a stub (see stub/elastix) that prints
+realistic output and writes realistic result files, but does not
+register anything, so that the time is spent almost entirely in
+pyelastix. It runs on any Linux box without Elastix installed.
+
+For each image size and dtype, reports the end-to-end latency of
+`register()`, the time spent in each phase, and the peak memory
+(as traced by tracemalloc, which includes numpy arrays). Times are
+the median over a number of runs, in milliseconds. The "stub" column is
+the time of running the stub elastix without pyelastix processing its
+output; the difference with the "elastix" column is the cost of
+handling the output.
+
+Usage: python benchmarks/bench_register.py [--repeat N] [--quick]
+"""
+
+import os
+import sys
+import time
+import argparse
+import platform
+import statistics
+import subprocess
+import tracemalloc
+
+import numpy as np
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(THIS_DIR))
+
+import pyelastix  # noqa: E402
+
+
+CASES = [
+    ((256, 256), 'float32'),
+    ((1024, 1024), 'float32'),
+    ((1024, 1024), 'uint8'),
+    ((64, 64, 64), 'float32'),
+    ((128, 128, 128), 'float32'),
+    ((128, 128, 128), 'int16'),
+]
+
+QUICK_CASES = [CASES[0], CASES[3]]
+
+PHASES = ['params', 'write', 'elastix', 'stub', 'transformix', 'read']
+
+
+def make_images(shape, dtype):
+    """ Create a pair of smooth images of the given shape and dtype.
+    """
+    grids = np.meshgrid(*[np.linspace(0, 4, n, dtype=np.float32)
+                          for n in shape], indexing='ij')
+    im = sum(np.sin(g) for g in grids)
+    im = (im - im.min()) * (100.0 / (im.max() - im.min()))
+    return im.astype(dtype), np.roll(im, 2, 0).astype(dtype)
+
+
+def time_phases(im1, im2, params):
+    """ Run a registration phase by phase, and return a dict with the
+    time spent in each phase (in seconds).
+    """
+    times = {}
+    t0 = time.perf_counter()
+    im1, p = pyelastix._get_registration_params(im1, im2, params, False)
+    times['params'] = time.perf_counter() - t0
+    with pyelastix.Workspace() as workspace:
+        t0 = time.perf_counter()
+        commands = pyelastix._prepare_registration(im1, im2, p, workspace)
+        times['write'] = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        pyelastix._system3(commands[0])
+        times['elastix'] = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        subprocess.check_call(commands[0], stdout=subprocess.DEVNULL)
+        times['stub'] = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        pyelastix._system3(commands[1])
+        times['transformix'] = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        pyelastix._finish_registration(workspace.path, False)
+        times['read'] = time.perf_counter() - t0
+    return times
+
+
+def time_register(im1, im2, params):
+    """ Get the end-to-end latency of register() (in seconds).
+    """
+    t0 = time.perf_counter()
+    pyelastix.register(im1, im2, params, verbose=0)
+    return time.perf_counter() - t0
+
+
+def peak_memory(im1, im2, params):
+    """ Get the peak memory that register() allocates (in bytes).
+    """
+    tracemalloc.start()
+    try:
+        pyelastix.register(im1, im2, params, verbose=0)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run(cases, repeat):
+    pyelastix.set_elastix_exes(os.path.join(THIS_DIR, 'stub', 'elastix'))
+    params = pyelastix.get_default_params()
+
+    print('Python %s, numpy %s, pyelastix %s, %s, %i cores\n' % (
+          platform.python_version(), np.__version__, pyelastix.__version__,
+          platform.platform(), os.cpu_count() or 1))
+    header = ['case', 'total'] + PHASES + ['peak MB', 'peak/im']
+    print('| ' + ' | '.join(header) + ' |')
+    print('|' + '|'.join(['---'] + ['--:'] * (len(header) - 1)) + '|')
+
+    for shape, dtype in cases:
+        im1, im2 = make_images(shape, dtype)
+        time_register(im1, im2, params)  # warm up
+        totals = [time_register(im1, im2, params) for i in range(repeat)]
+        phases = [time_phases(im1, im2, params) for i in range(repeat)]
+        peak = peak_memory(im1, im2, params)
+        row = ['x'.join(map(str, shape)) + ' ' + dtype,
+               '%.0f' % (1000 * statistics.median(totals))]
+        for phase in PHASES:
+            values = [p[phase] for p in phases]
+            row.append('%.1f' % (1000 * statistics.median(values)))
+        row += ['%.1f' % (peak / 2 ** 20), '%.1f' % (peak / im1.nbytes)]
+        print('| ' + ' | '.join(row) + ' |')
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of runs per case (default 5)')
+    parser.add_argument('--quick', action='store_true',
+                        help='only run a small 2D and 3D case')
+    args = parser.parse_args()
+    run(QUICK_CASES if args.quick else CASES, args.repeat)
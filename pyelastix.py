@@ -17,12 +17,25 @@ __version__ = '1.2'
 import os
 import re
 import sys
+import json
 import time
+import mmap
+import zlib
 import ctypes
+import struct
+import atexit
+import asyncio
+import contextlib
+import collections
+import shutil
+import hashlib
+import itertools
 import tempfile
 import threading
 import subprocess
+import weakref
 import warnings
+import concurrent.futures as _futures
 
 import numpy as np
 
@@ -167,6 +180,11 @@ EXES = []
 def get_elastix_exes():
     """ Get the executables for elastix and transformix. Raises an error
     if they cannot be found.
+    
+    The executables can be given explicitly using `set_elastix_exes()` or
+    the `ELASTIX_EXE` and `TRANSFORMIX_EXE` environment variables. Otherwise
+    they are searched for (see `ELASTIX_PATH`). The result of this search
+    is stored on disk, so that other processes can skip it.
     """
     if EXES:
         if EXES[0]:
@@ -174,14 +192,32 @@ def get_elastix_exes():
         else:
             raise RuntimeError('No Elastix executable.')
     
+    # Given via environment variables?
+    if os.environ.get('ELASTIX_EXE', ''):
+        set_elastix_exes(os.environ['ELASTIX_EXE'],
+                         os.environ.get('TRANSFORMIX_EXE', '') or None)
+        return EXES
+    
+    # Found before?
+    exes = _load_exes_from_cache()
+    if exes:
+        EXES.extend(exes)
+        return EXES
+    
     # Find exe
     elastix, ver = _find_executables('elastix')
     if elastix:
         base, ext = os.path.splitext(elastix)
         base = os.path.dirname(base)
         transformix = os.path.join(base, 'transformix' + ext)
+        if not _get_exe_path(transformix):
+            transformix, _ = _find_executables('transformix')
+            if not transformix:
+                raise RuntimeError('Found Elastix executable in %r, but '
+                                   'not Transformix.' % elastix)
         EXES.extend([elastix, transformix])
         print('Found %s in %r' % (ver, elastix))
+        _save_exes_to_cache(EXES)
         return EXES
     else:
         raise RuntimeError('Could not find Elastix executable. Download '
@@ -190,6 +226,104 @@ def get_elastix_exes():
                            'Set ELASTIX_PATH if necessary.')
 
 
+def set_elastix_exes(elastix, transformix=None):
+    """ set_elastix_exes(elastix, transformix=None)
+    
+    Set the paths of the executables for elastix and transformix, so that
+    pyelastix does not have to search for them. If `transformix` is not
+    given, it is assumed to be next to the elastix executable. The
+    `ELASTIX_EXE` and `TRANSFORMIX_EXE` environment variables can be used
+    to the same effect.
+    """
+    if not transformix:
+        base, ext = os.path.splitext(elastix)
+        transformix = os.path.join(os.path.dirname(base), 'transformix' + ext)
+    EXES[:] = [elastix, transformix]
+
+
+def _get_exe_path(exe):
+    """ Get the full path of an executable (which may be on the PATH).
+    Returns None if it does not exist.
+    """
+    if os.path.isfile(exe):
+        return os.path.abspath(exe)
+    return shutil.which(exe)
+
+
+def _get_user_cache_dir():
+    """ Get the per-user directory to store information in that other
+    users must not be able to change.
+    """
+    if sys.platform.startswith('win'):
+        base = os.environ.get('LOCALAPPDATA', '') or os.path.expanduser('~')
+    else:
+        base = (os.environ.get('XDG_CACHE_HOME', '') or
+                os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'pyelastix')
+
+
+def _get_exes_cache_file():
+    """ Get the file to store the found executables in. This is in a
+    per-user directory, since the executables in it are run without
+    further checks.
+    """
+    return os.path.join(_get_user_cache_dir(), 'exes.json')
+
+
+def _is_own_file(filename):
+    """ Get whether the given file is owned by the current user (always
+    True on Windows, where files in the user's profile are private).
+    """
+    if not hasattr(os, 'getuid'):
+        return True
+    return os.stat(filename).st_uid == os.getuid()
+
+
+def _load_exes_from_cache():
+    """ Get the executables that were found before for the current value
+    of ELASTIX_PATH, if they still exist and have not been modified.
+    """
+    key = os.environ.get('ELASTIX_PATH', '')
+    filename = _get_exes_cache_file()
+    try:
+        if not _is_own_file(filename):
+            return None
+        with open(filename, 'rb') as f:
+            elastix, transformix, mtime = json.loads(f.read().decode())[key]
+        if os.path.getmtime(_get_exe_path(elastix)) != mtime:
+            return None
+        for exe in (elastix, transformix):
+            if not os.access(_get_exe_path(exe), os.X_OK):
+                return None
+    except Exception:
+        return None
+    return [elastix, transformix]
+
+
+def _save_exes_to_cache(exes):
+    """ Store the found executables on disk, for other processes.
+    """
+    key = os.environ.get('ELASTIX_PATH', '')
+    filename = _get_exes_cache_file()
+    try:
+        try:
+            with open(filename, 'rb') as f:
+                data = json.loads(f.read().decode())
+        except Exception:
+            data = {}
+        mtime = os.path.getmtime(_get_exe_path(exes[0]))
+        data[key] = [exes[0], exes[1], mtime]
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename), 0o700)
+        # Write to temp file and rename, so that readers never see half
+        tmp = '%s.%i' % (filename, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(json.dumps(data).encode())
+        os.replace(tmp, filename)
+    except Exception:
+        pass  # Not being able to cache is not a problem
+
+
 # %% Code for maintaing the temp dirs
 
 
@@ -197,6 +331,8 @@ def _clear_dir(dirName):
     """ Remove a directory and it contents. Ignore any failures.
     """
     # If we got here, clear dir  
+    if not os.path.isdir(dirName):
+        return
     for fname in os.listdir(dirName):
         try:
             os.remove(os.path.join(dirName, fname))
@@ -208,24 +344,13 @@ def _clear_dir(dirName):
         pass
 
 
-def get_tempdir():
-    """ Get the temporary directory where pyelastix stores its temporary
-    files. The directory is specific to the current process and the
-    calling thread. Generally, the user does not need this; directories
-    are automatically cleaned up. Though Elastix log files are also
-    written here.
+def _clean_temproot(tempdir):
+    """ Remove the directories of processes that no longer exist.
     """
-    tempdir = os.path.join(tempfile.gettempdir(), 'pyelastix')
-    
-    # Make sure it exists
-    if not os.path.isdir(tempdir):
-        os.makedirs(tempdir)
-    
-    # Clean up all directories for which the process no longer exists
     for fname in os.listdir(tempdir):
         dirName = os.path.join(tempdir, fname)
         # Check if is right kind of dir
-        if not (os.path.isdir(dirName) and fname.startswith('id_')):
+        if not (fname.startswith('id_') and os.path.isdir(dirName)):
             continue
         # Get pid and check if its running
         try:
@@ -234,33 +359,115 @@ def get_tempdir():
             continue
         if not _is_pid_running(pid):
             _clear_dir(dirName)
+
+
+def _clean_own_dirs(tempdir):
+    """ Remove the directories of this process; registered to run at exit,
+    for files that could not be removed before (e.g. memory mapped files
+    on Windows). What is still in use is left for a later process.
+    """
+    import gc
+    gc.collect()  # Close the maps of arrays that are no longer used
+    prefix = 'id_%i_' % os.getpid()
+    for fname in os.listdir(tempdir):
+        if fname.startswith(prefix):
+            _clear_dir(os.path.join(tempdir, fname))
+
+
+_janitor = None
+_janitor_lock = threading.Lock()
+
+
+def _get_temproot():
+    """ Get the directory that contains the temporary directories. The
+    first call in a process starts a background thread that cleans up
+    the directories of processes that no longer exist, and makes sure
+    that the directories of this process are removed at exit.
+    """
+    global _janitor
+    tempdir = os.path.join(tempfile.gettempdir(), 'pyelastix')
     
-    # Select dir that included process and thread id
-    if hasattr(threading, 'current_thread'):
-        tid = id(threading.current_thread())
-    else:
-        tid = id(threading.currentThread())
-    dir = os.path.join(tempdir, 'id_%i_%i' % (os.getpid(), tid))
-    if not os.path.isdir(dir):
-        os.mkdir(dir)
+    # Make sure it exists
+    if not os.path.isdir(tempdir):
+        os.makedirs(tempdir, exist_ok=True)
+    
+    # Clean up stale directories, once per process
+    with _janitor_lock:
+        if _janitor is None:
+            _janitor = threading.Thread(target=_clean_temproot,
+                                        args=(tempdir, ),
+                                        name='pyelastix-janitor')
+            _janitor.daemon = True
+            _janitor.start()
+            atexit.register(_clean_own_dirs, tempdir)
+    
+    return tempdir
+
+
+_thread_local = threading.local()
+
+
+def get_tempdir():
+    """ Get the temporary directory where pyelastix stores its temporary
+    files. The directory is specific to the current process and the
+    calling thread. Generally, the user does not need this; registrations
+    use their own Workspace, and directories are automatically cleaned up.
+    """
+    dir = getattr(_thread_local, 'tempdir', None)
+    if dir is None or not os.path.isdir(dir):
+        dir = Workspace().path
+        _thread_local.tempdir = dir
     return dir
 
 
-def _clear_temp_dir():
-    """ Clear the temporary directory.
+class Workspace:
+    """ Workspace()
+    
+    A new, uniquely named temporary directory to hold the files of a
+    single job (e.g. a registration). It is removed with ``close()``, or
+    on exit when used as a context manager. Workspaces of processes that
+    no longer exist are cleaned up automatically.
+    
+    A workspace can be passed to ``register()`` to keep the files that
+    Elastix produces (including its log) for inspection.
     """
-    tempdir = get_tempdir()
-    for fname in os.listdir(tempdir):
-        try:
-            os.remove( os.path.join(tempdir, fname) )
-        except Exception:
-            pass
+    
+    def __init__(self):
+        prefix = 'id_%i_' % os.getpid()
+        self.path = tempfile.mkdtemp(prefix=prefix, dir=_get_temproot())
+    
+    def __repr__(self):
+        return '<Workspace %r>' % self.path
+    
+    def __fspath__(self):
+        return self.path
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+    
+    def clear(self):
+        """ Remove all files in the workspace.
+        """
+        for fname in os.listdir(self.path):
+            try:
+                os.remove(os.path.join(self.path, fname))
+            except Exception:
+                pass
+    
+    def close(self):
+        """ Remove the workspace and its contents.
+        """
+        _clear_dir(self.path)
 
 
-def _get_image_paths(im1, im2):
+def _get_image_paths(im1, im2, workspace=None):
     """ If the images are paths to a file, checks whether the file exist
     and return the paths. If the images are numpy arrays, writes them
-    to disk and returns the paths of the new files.
+    to disk (in the given Workspace or the default temporary directory)
+    and returns the paths of the new files.
     """
     
     paths = []
@@ -280,7 +487,10 @@ def _get_image_paths(im1, im2):
         elif isinstance(im, np.ndarray):
             # Given a numpy array
             id = len(paths)+1
-            p = _write_image_data(im, id)
+            if _input_cache is not None and _get_file_location(im) is None:
+                p = _write_cached_image_data(im, paths)
+            else:
+                p = _write_image_data(im, id, workspace)
             paths.append(p)
         
         else:
@@ -291,38 +501,409 @@ def _get_image_paths(im1, im2):
     return tuple(paths)
 
 
+# %% Code for caching data on disk
+
+
+class _DiskCache:
+    """ A directory in which each entry is a subdirectory, identified by
+    a key (e.g. a hash of its content). When the total size exceeds
+    `max_size` bytes, the least recently used entries are removed.
+    Multiple processes can safely use the same cache directory.
+    """
+    
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    
+    def get(self, key):
+        """ Get the directory of the entry with the given key, or None
+        if there is no such entry. Marks the entry as recently used.
+        """
+        path = os.path.join(self.directory, key)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+    
+    def new_entry(self):
+        """ Create a (temporary) directory to write a new entry to. Pass
+        it to `add()` once it is complete.
+        """
+        return tempfile.mkdtemp(prefix='tmp_', dir=self.directory)
+    
+    def add(self, key, path, keep=()):
+        """ Add the entry that is written in the given directory (as
+        obtained with `new_entry()`) under the given key. Returns the
+        directory of the entry. The new entry and the entries in `keep`
+        are not evicted.
+        """
+        target = os.path.join(self.directory, key)
+        try:
+            os.rename(path, target)
+        except OSError:
+            # Another process (or thread) has added it in the mean time
+            _clear_dir(path)
+        self.evict([target] + list(keep))
+        return target
+    
+    def evict(self, keep=()):
+        """ Remove least recently used entries until the total size is
+        within the limit. The entries in `keep` (e.g. those that are about
+        to be used) are not removed, even if they exceed the limit.
+        """
+        entries = []
+        total = 0
+        for key in os.listdir(self.directory):
+            if key.startswith('tmp_'):
+                continue
+            path = os.path.join(self.directory, key)
+            try:
+                size = sum(os.path.getsize(os.path.join(path, fname))
+                           for fname in os.listdir(path))
+                entries.append((os.path.getmtime(path), size, path))
+            except OSError:
+                continue  # Removed in the mean time
+            total += size
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            if path in keep:
+                continue
+            _clear_dir(path)
+            total -= size
+
+
+_input_cache = None
+
+
+def set_input_cache(max_size, directory=None):
+    """ set_input_cache(max_size, directory=None)
+    
+    Enable caching of input images. When enabled, each distinct image
+    (identified by a hash of its data, dtype, shape, sampling and origin)
+    that is passed to `register()` is written to disk only once. This
+    is useful when e.g. registering many images to the same fixed image.
+    The cache is stored in the given directory (by default in the
+    system's temp directory) and can be shared between processes. The
+    least recently used images are removed when the cache exceeds
+    `max_size` bytes. Set `max_size` to zero to disable the cache.
+    """
+    global _input_cache
+    if not max_size:
+        _input_cache = None
+        return
+    if directory is None:
+        directory = os.path.join(tempfile.gettempdir(), 'pyelastix',
+                                 'input_cache')
+    _input_cache = _DiskCache(directory, max_size)
+
+
+_result_cache = None
+
+# The files that make up the result of a registration
+RESULT_FILES = re.compile(r'(result\.\d+\.(mhd|raw|zraw)|'
+                          r'deformationField\.(mhd|raw)|'
+                          r'TransformParameters\.\d+\.txt)$')
+
+
+def set_result_cache(max_size, directory=None):
+    """ set_result_cache(max_size, directory=None)
+    
+    Enable caching of registration results. When enabled, `register()`
+    stores its result (the deformed image, the deformation field and the
+    transform parameters) on disk, and returns the stored result when
+    called again with the same images and parameters, instead of running
+    Elastix. To make the results reproducible, the `RandomSeed` parameter
+    is set (unless given). The cache is stored in the given directory
+    (by default in the system's temp directory) and can be shared between
+    processes. The least recently used results are removed when the cache
+    exceeds `max_size` bytes. Set `max_size` to zero to disable the cache.
+    """
+    global _result_cache
+    if not max_size:
+        _result_cache = None
+        return
+    if directory is None:
+        directory = os.path.join(tempfile.gettempdir(), 'pyelastix',
+                                 'result_cache')
+    _result_cache = _DiskCache(directory, max_size)
+
+
+def _get_result_key(im1, im2, params, masks=(None, None),
+                    field_engine='transformix'):
+    """ Get the key for the result cache, based on the input images (and
+    masks), the (compiled) parameters of each stage, and the options that
+    affect the result.
+    """
+    ims = list(im1) if isinstance(im1, (tuple, list)) else [im1]
+    ims.append(im2)
+    if any(m is not None for m in masks):
+        ims.extend(masks)
+    hashes = []
+    for im in ims:
+        if im is None:
+            hashes.append(None)
+        elif isinstance(im, str):
+            # A file location; assume the file is the same if it looks so
+            if not os.path.isfile(im):
+                raise ValueError('Image location does not exist.')
+            st = os.stat(im)
+            hashes.append((os.path.abspath(im), st.st_size, st.st_mtime))
+        else:
+            hashes.append(_hash_image(im))
+    stages = [sorted((key, repr(val)) for key, val in p.items())
+              for p in params]
+    text = repr((hashes, stages[0] if len(stages) == 1 else stages,
+                 field_engine))
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def _store_result(key, dirname):
+    """ Store the result of a registration in the result cache.
+    """
+    path = _result_cache.new_entry()
+    fnames = [fname for fname in os.listdir(dirname)
+              if RESULT_FILES.match(fname)]
+    _copy_files(dirname, path, fnames)
+    _result_cache.add(key, path)
+
+
+def _copy_files(source, target, fnames=None):
+    """ Copy files from one directory to another. Files are hard-linked
+    if possible.
+    """
+    if not os.path.isdir(target):
+        os.makedirs(target)
+    for fname in (fnames or os.listdir(source)):
+        filename1 = os.path.join(source, fname)
+        filename2 = os.path.join(target, fname)
+        if os.path.isfile(filename2):
+            os.remove(filename2)
+        try:
+            os.link(filename1, filename2)
+        except (OSError, AttributeError):
+            shutil.copyfile(filename1, filename2)
+
+
+def _hash_image(im):
+    """ Get a hash (as a hex string) of the data and metadata of an image.
+    """
+    h = hashlib.sha1()
+    sampling = getattr(im, 'sampling', [1 for _ in im.shape])
+    origin = getattr(im, 'origin', [0 for _ in im.shape])
+    meta = (im.dtype.str, im.shape, [float(s) for s in sampling],
+            [float(o) for o in origin])
+    h.update(repr(meta).encode())
+    h.update(np.ascontiguousarray(im).data)
+    return h.hexdigest()
+
+
+def _write_cached_image_data(im, keep=()):
+    """ Write a numpy array to the input cache (if it's not already in
+    there). Returns the path of the mhd file. The files in `keep` (e.g.
+    the other image of the registration) stay in the cache.
+    """
+    key = _hash_image(im)
+    path = _input_cache.get(key)
+    if path is None:
+        path = _input_cache.new_entry()
+        _write_image_data(im, 1, path)
+        keep = [os.path.dirname(p) for p in keep]
+        path = _input_cache.add(key, path, keep)
+    return os.path.join(path, 'im1.mhd')
+
+
 # %% Some helper stuff
 
-def _system3(cmd, verbose=False):
+class _ThreadBudget:
+    """ Hand out the threads that Elastix and Transformix may use, so
+    that concurrent registrations do not oversubscribe the CPU. Each
+    process gets `per_job` threads (via the -threads argument) and
+    waits until these are available within the `total` budget. Without
+    a budget, no limit is applied. Threads and coroutines that wait are
+    served in the order in which they came.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters = collections.deque()  # callbacks that take n
+        self._in_use = 0
+        self.total = self.per_job = None
+        self.configured = False
+    
+    def configure(self, total, per_job=None):
+        with self._lock:
+            self.total = self.per_job = None
+            if total is not None:
+                self.total = int(total)
+                self.per_job = min(int(per_job or total), self.total)
+                if self.per_job < 1:
+                    raise ValueError('The thread budget must be positive.')
+            self.configured = True
+            self._wake_waiters()
+    
+    def _available(self):
+        n = self.per_job
+        return (n is None or self.total is None or not self._in_use or
+                self._in_use + n <= self.total)
+    
+    def _take(self):
+        n = self.per_job
+        if n is not None:
+            self._in_use += n
+        return n
+    
+    def _wake_waiters(self):
+        """ Hand out threads to the waiters, first come first served.
+        """
+        while self._waiters and self._available():
+            self._waiters.popleft()(self._take())
+    
+    def acquire(self, blocking=True):
+        """ Wait until threads are available and take them. Returns the
+        number of threads, or None if there is no budget. If not
+        `blocking`, returns False instead of waiting.
+        """
+        if not self.configured:
+            _load_thread_budget()
+        with self._lock:
+            if not self._waiters and self._available():
+                return self._take()
+            if not blocking:
+                return False
+            event = threading.Event()
+            result = []
+            self._waiters.append(lambda n: (result.append(n), event.set()))
+        event.wait()
+        return result[0]
+    
+    async def acquire_async(self):
+        """ Coroutine version of `acquire()`, which waits without blocking
+        the event loop. If cancelled, no threads are taken.
+        """
+        if not self.configured:
+            _load_thread_budget()
+        loop = asyncio.get_event_loop()
+        with self._lock:
+            if not self._waiters and self._available():
+                return self._take()
+            future = loop.create_future()
+            granted = []
+            
+            def wake(n):
+                granted.append(n)
+                loop.call_soon_threadsafe(
+                    lambda: future.done() or future.set_result(n))
+            
+            self._waiters.append(wake)
+        try:
+            return await future
+        except asyncio.CancelledError:
+            with self._lock:
+                if not granted:
+                    self._waiters.remove(wake)
+            if granted:
+                self.release(granted[0])
+            raise
+    
+    def release(self, n):
+        if n is not None:
+            with self._lock:
+                self._in_use -= n
+                self._wake_waiters()
+    
+    @contextlib.contextmanager
+    def threads(self):
+        """ Context manager to hold threads while running a process.
+        """
+        n = self.acquire()
+        try:
+            yield n
+        finally:
+            self.release(n)
+
+
+_thread_budget = _ThreadBudget()
+
+
+def set_thread_budget(total, threads_per_job=None):
+    """ set_thread_budget(total, threads_per_job=None)
+    
+    Limit the total number of threads that the Elastix and Transformix
+    processes of this process may use at the same time. Each process is
+    given `threads_per_job` threads (default `total`), and waits until
+    these are available, so that concurrent registrations (e.g. from a
+    thread pool) are queued instead of oversubscribing the CPU. Use None
+    to remove the limit (the default), in which case Elastix uses all
+    cores.
+    
+    The budget can also be set with the `PYELASTIX_THREADS` and
+    `PYELASTIX_THREADS_PER_JOB` environment variables. `register_many()`
+    divides the budget (or the number of cores) between its workers.
+    """
+    _thread_budget.configure(total, threads_per_job)
+
+
+def get_thread_budget():
+    """ get_thread_budget()
+    
+    Get the `(total, threads_per_job)` thread budget, as set with
+    `set_thread_budget()` or the environment variables. Both are None
+    if there is no limit.
+    """
+    if not _thread_budget.configured:
+        _load_thread_budget()
+    return _thread_budget.total, _thread_budget.per_job
+
+
+def _load_thread_budget():
+    """ Set the thread budget from the environment variables.
+    """
+    total = os.environ.get('PYELASTIX_THREADS', '')
+    per_job = os.environ.get('PYELASTIX_THREADS_PER_JOB', '')
+    try:
+        _thread_budget.configure(int(total) if total else None,
+                                 int(per_job) if per_job else None)
+    except ValueError:
+        raise ValueError('Invalid value for PYELASTIX_THREADS(_PER_JOB).')
+
+
+def _system3(cmd, verbose=False, callback=None, stopper=None):
     """ Execute the given command in a subprocess and wait for it to finish.
-    A thread is run that prints output of the process if verbose is True.
+    A thread is run that processes the output of the process (see
+    `_OutputHandler`). If `stopper` is given and returns True for a
+    progress event, the process is killed. Returns whether that happened.
+    The process runs when there are enough threads in the thread budget
+    (see `set_thread_budget()`).
+    """
+    with _thread_budget.threads() as n:
+        if n is not None:
+            cmd = list(cmd) + ['-threads', str(n)]
+        return _system3_now(cmd, verbose, callback, stopper)
+
+
+def _system3_now(cmd, verbose=False, callback=None, stopper=None):
+    """ Execute the given command, see `_system3()`.
     """
     
     # Init flag
     interrupted = False
     
-    # Create progress
-    if verbose > 0:
-        progress = Progress()
-    
-    stdout = []
+    handler = _OutputHandler(verbose, callback, stopper)
 
     def poll_process(p):
         while not interrupted:
             msg = p.stdout.readline().decode()
             if msg:
-                stdout.append(msg)
-                if 'error' in msg.lower():
-                    print(msg.rstrip())
-                    if verbose == 1:
-                        progress.reset()
-                elif verbose > 1:
-                    print(msg.rstrip())
-                elif verbose == 1:
-                    progress.update(msg)
+                handler.feed(msg)
+                if handler.stopped:
+                    p.kill()
+                    break
             else:
                 break
-            time.sleep(0.01)
         #print("thread exit")
     
     # Start process that runs the command
@@ -333,13 +914,15 @@ def _system3(cmd, verbose=False):
     # Keep reading stdout from it
     # thread.start_new_thread(poll_process, (p,))  Python 2.x
     my_thread = threading.Thread(target=poll_process, args=(p,))
-    my_thread.setDaemon(True)
+    my_thread.daemon = True
     my_thread.start()
     
     # Wait here
     try:
         while p.poll() is None:
             time.sleep(0.01)
+        # Make sure that all output has been processed
+        my_thread.join()
     except KeyboardInterrupt:
         # Set flag
         interrupted = True
@@ -357,12 +940,93 @@ def _system3(cmd, verbose=False):
     # All good?
     if interrupted:
         raise RuntimeError('Registration process interrupted by the user.')
+    if p.returncode and not handler.stopped:
+        print(''.join(handler.stdout))
+        raise RuntimeError('An error occured during the registration.')
+    return handler.stopped
+
+
+async def _system3_async(cmd, verbose=False, callback=None):
+    """ Execute the given command in a subprocess and wait for it to
+    finish, using asyncio. The output is read as it becomes available.
+    If the coroutine is cancelled, the subprocess is killed.
+    """
+    
+    handler = _OutputHandler(verbose, callback)
+    
+    # Take threads from the budget, without blocking the event loop
+    n = await _thread_budget.acquire_async()
+    if n is not None:
+        cmd = list(cmd) + ['-threads', str(n)]
+    
+    # Start process that runs the command
+    try:
+        p = await asyncio.create_subprocess_exec(
+            *cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    except BaseException:
+        _thread_budget.release(n)
+        raise
+    
+    # Read its output until it closes, and wait for it to finish
+    try:
+        while True:
+            msg = (await p.stdout.readline()).decode()
+            if not msg:
+                break
+            handler.feed(msg)
+        await p.wait()
+    except asyncio.CancelledError:
+        if p.returncode is None:
+            try:
+                p.kill()
+            except ProcessLookupError:  # pragma: no cover
+                pass  # Finished in the mean time
+            await p.wait()
+        raise
+    finally:
+        _thread_budget.release(n)
+    
+    # All good?
     if p.returncode:
-        stdout.append(p.stdout.read().decode())
-        print(''.join(stdout))
+        print(''.join(handler.stdout))
         raise RuntimeError('An error occured during the registration.')
 
 
+class _OutputHandler:
+    """ Process the output of Elastix/Transformix line by line: store
+    it, parse it into `ProgressEvent` objects that are passed to the
+    callback (if given), and show the output or the progress, depending
+    on the verbosity. If `stopper` returns True for an event, `stopped`
+    is set, to signal that the process should be stopped.
+    """
+    
+    def __init__(self, verbose, callback=None, stopper=None):
+        self.stdout = []
+        self.stopped = False
+        self._verbose = verbose
+        self._callback = callback
+        self._stopper = stopper
+        self._parser = _OutputParser()
+        self._progress = Progress() if verbose == 1 else None
+    
+    def feed(self, msg):
+        self.stdout.append(msg)
+        event = self._parser.feed(msg)
+        if event is not None:
+            if self._callback is not None:
+                self._callback(event)
+            if self._progress is not None:
+                self._progress.update(event)
+            if self._stopper is not None and not self.stopped:
+                self.stopped = bool(self._stopper(event))
+        if 'error' in msg.lower():
+            print(msg.rstrip())
+            if self._progress is not None:
+                self._progress.reset()
+        elif self._verbose > 1:
+            print(msg.rstrip())
+
+
 def _get_dtype_maps():
     """ Get dictionaries to map numpy data types to ITK types and the 
     other way around.
@@ -388,29 +1052,137 @@ def _get_dtype_maps():
 DTYPE_NP2ITK, DTYPE_ITK2NP = _get_dtype_maps()
 
 
+class ProgressEvent:
+    """ Object that describes the progress of an Elastix registration,
+    as passed to the `callback` of `register()`. The `kind` attribute
+    is one of:
+    
+    * 'resolution': a new resolution level is started.
+    * 'iteration': an iteration has been performed.
+    * 'resolution_done': a resolution level is finished.
+    
+    The `resolution` attribute is the index of the current resolution
+    level, and `stage` the index of the current stage of a multi-stage
+    registration (see `register()`). For iteration events,
+    `iteration`, `metric`, `step_size` and `gradient` (the magnitude of
+    the gradient) are set, as well as `time` (the duration of the
+    iteration in seconds). For 'resolution_done' events, `time` is the
+    time spent in that resolution in seconds. Attributes that are not
+    known are None.
+    """
+    
+    def __init__(self, kind, resolution, iteration=None, metric=None,
+                 step_size=None, gradient=None, time=None, stage=0):
+        self.kind = kind
+        self.stage = stage
+        self.resolution = resolution
+        self.iteration = iteration
+        self.metric = metric
+        self.step_size = step_size
+        self.gradient = gradient
+        self.time = time
+    
+    def __repr__(self):
+        keys = ('stage', 'resolution', 'iteration', 'metric', 'step_size',
+                'gradient', 'time')
+        values = ['%s=%s' % (key, getattr(self, key)) for key in keys
+                  if getattr(self, key) is not None]
+        return '<ProgressEvent %s %s>' % (self.kind, ' '.join(values))
+
+
+class _OutputParser:
+    """ Parse the output of Elastix into `ProgressEvent` objects.
+    """
+    
+    # Columns of the iteration table that we are interested in
+    COLUMNS = {'ItNr': 'iteration', 'Metric': 'metric',
+               'StepSize': 'step_size', '||Gradient||': 'gradient',
+               'Time[ms]': 'time'}
+    
+    def __init__(self):
+        self._stage = 0
+        self._level = 0
+        self._columns = {0: 'iteration', 1: 'metric'}
+    
+    def feed(self, s):
+        """ Process a line of output. Returns a ProgressEvent or None.
+        """
+        # Detect stage and resolution
+        if s.startswith('Running elastix with parameter file'):
+            self._stage = _get_int(s.split(':')[0].split()[-1])
+            return None
+        if s.startswith('Resolution:'):
+            self._level = _get_int(s.split(':')[1])
+            return ProgressEvent('resolution', self._level,
+                                 stage=self._stage)
+        if s.startswith('Time spent in resolution'):
+            seconds = _get_float(s.rsplit(':', 1)[1].strip(' s.\n'))
+            return ProgressEvent('resolution_done', self._level,
+                                 time=seconds, stage=self._stage)
+        if '\t' not in s:
+            return None
+        # Detect the header of the iteration table
+        parts = [part.strip() for part in s.split('\t')]
+        if 'ItNr' in parts[0]:
+            self._columns = {}
+            for i, part in enumerate(parts):
+                name = part.split(':', 1)[-1]
+                if name in self.COLUMNS:
+                    self._columns[i] = self.COLUMNS[name]
+            return None
+        # Check if iteration
+        try:
+            int(parts[0])
+        except ValueError:
+            return None
+        values = {}
+        for i, name in self._columns.items():
+            if i < len(parts):
+                values[name] = _get_float(parts[i])
+        if values.get('iteration') is not None:
+            values['iteration'] = int(values['iteration'])
+        if values.get('time') is not None:
+            values['time'] = values['time'] / 1000.0
+        return ProgressEvent('iteration', self._level, stage=self._stage,
+                             **values)
+
+
+def _get_int(s):
+    nr = 0
+    try:
+        nr = int(s)
+    except Exception:
+        pass
+    return nr
+
+
+def _get_float(s):
+    try:
+        return float(s)
+    except Exception:
+        return None
+
+
 class Progress:
     
+    # Minimal time between updates, to avoid flooding the console
+    interval = 0.2
+    
     def __init__(self):
         self._level = 0
+        self._last_time = 0
         self.reset()
     
-    def update(self, s):
+    def update(self, event):
         # Detect resolution
-        if s.startswith('Resolution:'):
-            self._level = self.get_int(s.split(':')[1])
-        # Check if nr
-        if '\t' in s:
-            iter = self.get_int(s.split('\t', 1)[0])
-            if iter:
-                self.show_progress(iter)
-    
-    def get_int(self, s):
-        nr = 0
-        try:
-            nr = int(s)
-        except Exception:
-            pass
-        return nr
+        if event.kind == 'resolution':
+            self._level = event.resolution
+            self._last_time = 0
+        # Check if nr, and whether it is time to show it
+        elif event.kind == 'iteration' and event.iteration:
+            if time.time() - self._last_time >= self.interval:
+                self._last_time = time.time()
+                self.show_progress(event.iteration)
     
     def reset(self):
         self._message = ''
@@ -424,11 +1196,193 @@ class Progress:
         print(rem + self._message)
     
 
+class EarlyStopping:
+    """ EarlyStopping(window=50, tolerance=1e-3, max_time=None)
+    
+    Policy to stop the last resolution of a registration early, to be
+    passed to `register()`. The last resolution is stopped when the
+    (best) metric value of the last `window` iterations is less than
+    `tolerance` (relative) better than the best value before that, or
+    when it takes more than `max_time` seconds. The transform with the
+    best metric value so far is then used as the result.
+    
+    Custom policies can be made by overloading `update()`.
+    """
+    
+    def __init__(self, window=50, tolerance=1e-3, max_time=None):
+        self.window = int(window)
+        self.tolerance = float(tolerance)
+        self.max_time = max_time
+        self.reset()
+    
+    def reset(self):
+        """ Reset the state; called when the last resolution starts.
+        """
+        self._metrics = []
+        self._t0 = time.perf_counter()
+    
+    def update(self, event):
+        """ Process a `ProgressEvent` of the last resolution. Returns True
+        if the registration should be stopped.
+        """
+        if self.max_time is not None:
+            if time.perf_counter() - self._t0 > self.max_time:
+                return True
+        if event.kind != 'iteration' or event.metric is None:
+            return False
+        self._metrics.append(event.metric)
+        if self.window <= 0 or len(self._metrics) < 2 * self.window:
+            return False
+        before = min(self._metrics[:-self.window])
+        recent = min(self._metrics[-self.window:])
+        scale = max(abs(before), 1e-12)
+        return (before - recent) / scale < self.tolerance
+
+
+class _EarlyStopper:
+    """ Apply an EarlyStopping policy to the output of Elastix, which
+    writes the transform of each iteration of the last resolution (of
+    the given stage) to `outdir`. Keeps track of (the file of) the best
+    iteration, removing the files of other iterations.
+    """
+    
+    def __init__(self, policy, outdir, n_resolutions, stage=0):
+        self._policy = policy
+        self._outdir = outdir
+        self._stage = stage
+        self._level = n_resolutions - 1
+        self._prefix = 'TransformParameters.%i.R%i.It' % (stage, self._level)
+        self._files = {}  # filename -> metric, of the files we keep
+        self._last = None
+    
+    def __call__(self, event):
+        if event.resolution != self._level or event.stage != self._stage:
+            return False
+        if event.kind == 'resolution':
+            self._policy.reset()
+        elif event.kind == 'iteration' and event.iteration is not None:
+            # The file of an iteration is written after its output, so
+            # clean up the file of the previous iteration if not the best
+            best = min(self._files.values(), default=None)
+            if self._last is not None and self._files[self._last] != best:
+                _remove_file(self._last)
+                self._files.pop(self._last)
+            self._last = os.path.join(self._outdir, '%s%07i.txt' %
+                                      (self._prefix, event.iteration))
+            metric = event.metric
+            self._files[self._last] = np.inf if metric is None else metric
+        return self._policy.update(event)
+    
+    def finish(self):
+        """ Get the file of the best transform, and remove the others.
+        The file of the last iteration is skipped, since Elastix may have
+        been killed while writing it.
+        """
+        written = [(metric, filename)
+                   for filename, metric in self._files.items()
+                   if filename != self._last and os.path.isfile(filename)]
+        if not written:
+            raise RuntimeError('Registration was stopped before a transform '
+                               'was written.')
+        best = min(written)[1]
+        self.clear(best)
+        return best
+    
+    def clear(self, keep=None):
+        """ Remove the files of the iterations (except `keep`).
+        """
+        for fname in os.listdir(self._outdir):
+            filename = os.path.join(self._outdir, fname)
+            if fname.startswith(self._prefix) and filename != keep:
+                _remove_file(filename)
+
+
+def _remove_file(filename):
+    try:
+        os.remove(filename)
+    except Exception:
+        pass
+
+
+class RegistrationReport:
+    """ RegistrationReport()
+    
+    Object that collects where the time of a registration is spent. Pass
+    an instance to `register()` to have it filled in, or use
+    `set_report_hook()` to receive a report for each registration. It
+    has the following attributes:
+    
+    * times (dict): the time (in seconds) of each phase that was
+      performed, in order: 'params', 'cache' (looking up the result),
+      'workspace', 'write_images', 'write_params', 'elastix',
+      'transformix', 'read_image' and 'read_field'.
+    * bytes_written (int): the number of bytes written to the workspace.
+    * bytes_read (int): the number of bytes of result data read.
+    * cached (bool): whether the result was obtained from the result
+      cache (see `set_result_cache()`).
+    * error (Exception): the error if the registration failed, else None.
+    """
+    
+    def __init__(self):
+        self.times = {}
+        self.bytes_written = 0
+        self.bytes_read = 0
+        self.cached = False
+        self.error = None
+    
+    def __repr__(self):
+        phases = ', '.join('%s: %.3f' % item for item in self.times.items())
+        return '<RegistrationReport %.3f s (%s)>' % (self.total, phases)
+    
+    @property
+    def total(self):
+        """ The total time of the phases (in seconds).
+        """
+        return sum(self.times.values())
+
+
+@contextlib.contextmanager
+def _measure(report, phase):
+    """ Context manager to add the time spent in a phase to the report
+    (if not None).
+    """
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        if report is not None:
+            t = time.perf_counter() - t0
+            report.times[phase] = report.times.get(phase, 0.0) + t
+
+
+_report_hook = None
+
+
+def set_report_hook(func):
+    """ set_report_hook(func)
+    
+    Set a function that is called with a `RegistrationReport` after each
+    call to `register()` (also when it fails), e.g. to forward the
+    timings to a metrics system. The function is called from the thread
+    (or process) that performs the registration. Errors raised by the
+    function are turned into warnings. Use None to remove it.
+    """
+    global _report_hook
+    if func is not None and not callable(func):
+        raise TypeError('The report hook must be callable.')
+    _report_hook = func
+
+
 # %% The Elastix registration class
 
 
-def register(im1, im2, params, exact_params=False, verbose=1):
-    """ register(im1, im2, params, exact_params=False, verbose=1)
+def register(im1, im2, params, exact_params=False, verbose=1, callback=None,
+             mmap=False, out=None, output_dir=None, return_transform=False,
+             field_engine='transformix', workspace=None,
+             field_layout='split', field_dtype=None, field_downsample=1,
+             report=None, early_stopping=None, initial_transform=None,
+             fixed_mask=None, moving_mask=None):
+    """ register(im1, im2, params, exact_params=False, verbose=1, ...)
     
     Perform the registration of `im1` to `im2`, using the given 
     parameters. Returns `(im1_deformed, field)`, where `field` is a
@@ -447,6 +1401,11 @@ def register(im1, im2, params, exact_params=False, verbose=1):
         parameter known to Elastix can be added to the parameter
         struct, which enables tuning the registration in great detail.
         See `get_default_params()` and the Elastix docs for more info.
+        A list of parameters performs a multi-stage registration (e.g.
+        rigid, then affine, then B-spline) in a single Elastix run: each
+        stage starts from the transform of the previous stage. The
+        returned transform is then a chain of the transforms of all
+        stages.
     * exact_params (bool):
         If True, use the exact given parameters. If False (default)
         will process the parameters, checking for incompatible
@@ -458,45 +1417,341 @@ def register(im1, im2, params, exact_params=False, verbose=1):
         produced by the Elastix executable. Note that error messages
         produced by Elastix will be printed regardless of the verbose
         level.
+    * callback (callable):
+        Optional function that is called with a `ProgressEvent` object
+        for each resolution and iteration, e.g. to track convergence.
+        It is called from the thread that reads the Elastix output.
+        Not called if the result is obtained from the result cache (see
+        `set_result_cache()`).
+    * mmap (bool):
+        If True, the resulting image and deformation field are memory
+        mapped from the files that Elastix produced, rather than loaded
+        into memory. The files are removed when the arrays are no longer
+        used (on Windows, when the process exits, or if they are still in
+        use then, by the next process that uses pyelastix). Default False.
+    * out (tuple):
+        Optional `(im_out, field_out)` tuple of preallocated C-contiguous
+        arrays to read the resulting image and deformation field into.
+        Either can be None. The `field_out` array must be able to hold
+        the data of all dimensions, i.e. have `ndim` times the number of
+        elements of the image. The returned arrays are views on these.
+    * output_dir (str):
+        Optional directory to write the output of Elastix to (the result
+        image, deformation field, transform parameters and log). Result
+        files of an earlier registration in it are replaced, and it is
+        not cleared afterwards. By default, a temporary directory is used.
+    * return_transform (bool):
+        If True, returns `(im1_deformed, field, transform)`, where
+        `transform` is a `Transform` object that can be used to apply the
+        same transformation to other images. Default False.
+    * field_engine (str):
+        How to compute the deformation field: 'transformix' (default) or
+        'numpy'. The latter evaluates the transform in this process (see
+        `Transform.field()`), which avoids running Transformix and writing
+        and reading the field to disk. Transformix is used anyway if the
+        transform is not supported, or for groupwise registration.
+    * workspace (Workspace):
+        Optional `Workspace` to write the temporary files to. It is
+        cleared first, but not removed afterwards, so that the files
+        (e.g. the Elastix log) can be inspected. By default, a new
+        workspace is created, and removed when done.
+    * field_layout (str):
+        The form in which the deformation field is returned. 'split'
+        (default) gives a tuple of (strided) views, one per dimension.
+        'contiguous' gives a tuple of contiguous arrays. 'stacked' gives
+        a single array with the dimensions stacked in the last axis (in
+        x-y-z order), without copying. 'magnitude' gives a single array
+        with the length of the displacement vectors.
+    * field_dtype (dtype):
+        Optional data type to store the field in, e.g. `np.float16` to
+        halve the memory. By default, the field is float32.
+    * field_downsample (int):
+        Optional integer factor to downsample the field by (taking every
+        n-th sample). Default 1. With `field_layout='magnitude'` and a
+        factor of 2, a 3D field takes 1/24 of the memory. The `sampling`
+        and `origin` attributes of the returned arrays are adjusted.
+    * report (RegistrationReport):
+        Optional `RegistrationReport` object that is filled in with the
+        time spent in each phase and the amount of data written and read.
+    * early_stopping (EarlyStopping):
+        Optional policy to stop the last resolution early, e.g. when the
+        metric does not improve anymore. The transform with the best
+        metric value so far is then used. Elastix cannot skip to the
+        next resolution, so earlier resolutions are always completed.
+        The result cache is not used in this case.
+    * initial_transform (Transform or file location):
+        Optional transform to start from (passed to Elastix as `-t0`),
+        e.g. that of a previous registration. The resulting transform
+        is a chain that starts with it. Its files are written to the
+        output directory. The result cache is not used in this case.
+        See also `register_sequence()`.
+    * fixed_mask (ndarray or file location):
+        Optional mask of the region of interest in the fixed image
+        (`im2`): a bool or uint8 array of the same shape, where nonzero
+        values are inside the region. Elastix then only takes samples
+        (and evaluates the metric) inside the region, which is faster
+        and ignores e.g. the background.
+    * moving_mask (ndarray or file location):
+        Optional mask of the region of interest in the moving image
+        (`im1`), like `fixed_mask`.
     
     If `im1` is a list of images, performs a groupwise registration.
     In this case the resulting `field` is a list of fields, each
-    indicating the deformation to the "average" image.
+    indicating the deformation to the "average" image. The images can
+    also be given as an iterator (e.g. a generator that loads each
+    frame), or as an array (e.g. an `np.memmap`) of the stacked images.
+    The frames are then written to disk one at a time, and the results
+    are memory mapped (as with `mmap=True`), so that the fields of each
+    frame are only loaded when used.
+    
+    If an image is an `np.memmap` (e.g. of an existing raw file), Elastix
+    reads the data directly from the mapped file, avoiding a copy.
     """
     
-    # Clear dir
-    tempdir = get_tempdir()
-    _clear_temp_dir()
+    # Collect a report for the hook?
+    if report is None and _report_hook is not None:
+        report = RegistrationReport()
+    own_workspace = workspace is None
+    
+    try:
+        # Check parameters
+        with _measure(report, 'params'):
+            im1, params = _get_registration_params(im1, im2, params,
+                                                   exact_params)
+            field_kwargs = _get_field_kwargs(field_layout, field_dtype,
+                                             field_downsample)
+            if field_engine not in ('numpy', 'transformix'):
+                raise ValueError('Invalid field_engine %r.' % field_engine)
+            if isinstance(initial_transform, str):
+                initial_transform = Transform.from_file(initial_transform)
+            if initial_transform is not None and im2 is None:
+                raise ValueError('Groupwise registration cannot have an '
+                                 'initial transform.')
+            masks = (_get_mask(fixed_mask, im2, 'fixed_mask'),
+                     _get_mask(moving_mask, im1, 'moving_mask'))
+            if im2 is None and any(m is not None for m in masks):
+                raise ValueError('Groupwise registration cannot have '
+                                 'masks.')
+            stage = len(params) - 1
+            if early_stopping is not None:
+                # Write the transform of each iteration in the last level
+                n = int(params[stage].get('NumberOfResolutions', 3))
+                params[stage]['WriteTransformParametersEachIteration'] = (
+                    [False] * (n - 1) + [True])
+        
+        # Streamed groupwise input produces results that may not fit in
+        # memory
+        streamed = im2 is None and not isinstance(im1, (tuple, list))
+        if streamed:
+            mmap = True
+        
+        # Maybe we have done this before (cannot hash an iterator of frames)
+        key = None
+        hashable = not (streamed and not isinstance(im1, np.ndarray))
+        if (_result_cache is not None and hashable and
+                not early_stopping and initial_transform is None):
+            with _measure(report, 'cache'):
+                # Elastix uses random sampling, so make it deterministic
+                for p in params:
+                    p.setdefault('RandomSeed', 121212)
+                key = _get_result_key(im1, im2, params, masks,
+                                      field_engine)
+                path = _result_cache.get(key)
+            if path is not None:
+                if report is not None:
+                    report.cached = True
+                if output_dir:
+                    _copy_files(path, output_dir)
+                result = _finish_registration(path, im2 is None, mmap, out,
+                                              report=report, stage=stage,
+                                              **field_kwargs)
+                if return_transform:
+                    result += (_get_transform(path, stage), )
+                return result
+        
+        # Get a clean workspace. Mapped results stay valid when it is
+        # closed. On Windows, mapped files cannot be removed, so they are
+        # removed at exit (or by a later process) instead.
+        with _measure(report, 'workspace'):
+            if own_workspace:
+                workspace = Workspace()
+            else:
+                workspace.clear()
+            outdir = output_dir or workspace.path
+            if not os.path.isdir(outdir):
+                os.makedirs(outdir)
+            elif output_dir:
+                # Results of an earlier run may be linked to the result
+                # cache, so unlink them instead of letting Elastix
+                # overwrite them
+                for fname in os.listdir(outdir):
+                    if RESULT_FILES.match(fname):
+                        os.remove(os.path.join(outdir, fname))
+        
+        # Write the input and compile the commands to execute
+        commands = _prepare_registration(im1, im2, params, workspace, outdir,
+                                         report, initial_transform, masks)
+        
+        # Maybe we don't need Transformix
+        if field_engine == 'numpy' and im2 is not None:
+            texts = [_params_to_text(p) for p in params]
+            if initial_transform is not None:
+                texts = initial_transform._texts + texts
+            if _can_evaluate(texts):
+                commands = commands[:1]
+        
+        # Register
+        if verbose:
+            print("Calling Elastix to register images ...")
+        stopper = None
+        if early_stopping is not None:
+            n = int(params[stage].get('NumberOfResolutions', 3))
+            stopper = _EarlyStopper(early_stopping, outdir, n, stage)
+        with _measure(report, 'elastix'):
+            stopped = _system3(commands[0], verbose, callback, stopper)
+        
+        # If stopped early, apply the best transform to get the result
+        if stopped:
+            commands[1:] = [_get_early_stop_command(commands, outdir,
+                                                    stopper.finish(), stage)]
+        elif stopper is not None:
+            stopper.clear()
+        
+        # Find deformation field
+        for command in commands[1:]:
+            with _measure(report, 'transformix'):
+                _system3(command, verbose, callback)
+        if stopped:
+            os.replace(os.path.join(outdir, 'result.mhd'),
+                       os.path.join(outdir, 'result.%i.mhd' % stage))
+        
+        # Load results, store them and return
+        result = _finish_registration(outdir, im2 is None, mmap, out,
+                                      report=report, stage=stage,
+                                      **field_kwargs)
+        if return_transform:
+            result += (_get_transform(outdir, stage), )
+        if key is not None:
+            _store_result(key, outdir)
+        return result
+    
+    except Exception as err:
+        if report is not None:
+            report.error = err
+        raise
+    finally:
+        if own_workspace and workspace is not None:
+            workspace.close()
+        if _report_hook is not None:
+            # An error in the hook must not affect the registration
+            try:
+                _report_hook(report)
+            except Exception as err:
+                warnings.warn('The report hook failed: %s: %s' %
+                              (type(err).__name__, err))
+
+
+async def register_async(im1, im2, params, exact_params=False, verbose=0,
+                         callback=None):
+    """ register_async(im1, im2, params, exact_params=False, verbose=0, ...)
+    
+    Coroutine version of `register()`, to be used with asyncio. The
+    output of Elastix is read as it comes in, without polling, so that
+    a single event loop can drive many registrations at once. Each call
+    uses its own temporary directory. Cancelling the task kills the
+    Elastix process.
+    
+    See `register()` for a description of the arguments and return value.
+    Note that `verbose` is zero by default.
+    """
+    
+    loop = asyncio.get_event_loop()
+    with Workspace() as workspace:
+        # Writing the images is done in a thread, to not block the loop
+        im1, params = _get_registration_params(im1, im2, params,
+                                               exact_params)
+        commands = await loop.run_in_executor(
+            None, _prepare_registration, im1, im2, params, workspace)
+        for command in commands:
+            await _system3_async(command, verbose, callback)
+        mmap = im2 is None and not isinstance(im1, (tuple, list))
+        return await loop.run_in_executor(
+            None, lambda: _finish_registration(workspace.path, im2 is None,
+                                               mmap, stage=len(params) - 1))
+
+
+async def transformix_async(transform_file, im=None, verbose=0):
+    """ transformix_async(transform_file, im=None, verbose=0)
+    
+    Coroutine to apply the transform described by an Elastix transform
+    parameter file (e.g. "TransformParameters.0.txt") using Transformix.
+    Returns `(im_deformed, field)`. If `im` (an ndarray or file location)
+    is given, it is deformed, otherwise `im_deformed` is None. The
+    `field` is a tuple of arrays as returned by `register()`. Cancelling
+    the task kills the Transformix process.
+    """
+    
+    loop = asyncio.get_event_loop()
+    with Workspace() as workspace:
+        # Compile command to execute
+        command = [get_elastix_exes()[1],
+                   '-def', 'all',
+                   '-out', workspace.path,
+                   '-tp', transform_file]
+        if im is not None:
+            path_im = await loop.run_in_executor(
+                None, _get_image_paths, im, None, workspace)
+            command += ['-in', path_im[0]]
+        await _system3_async(command, verbose)
+        
+        # Load results
+        a = None
+        if im is not None:
+            a = await loop.run_in_executor(
+                None, _read_result, 'result.mhd', workspace.path,
+                'transformation')
+        b = await loop.run_in_executor(
+            None, _read_result, 'deformationField.mhd', workspace.path,
+            'transformation')
+        return a, _split_fields(b, False)
+
+
+def _get_registration_params(im1, im2, params, exact_params):
+    """ Get the dictionaries of parameters to use for a registration,
+    one for each stage. Returns `(im1, stages)`, where `im1` is a new
+    iterator if the images for a groupwise registration are given as an
+    iterator.
+    """
     
     # Reference image
     refIm = im1
-    if isinstance(im1, (tuple,list)):
-        refIm = im1[0]
+    if im2 is None:
+        refIm, im1 = _peek_frames(im1)
     
-    # Check parameters
-    if not exact_params:
-        params = _compile_params(params, refIm)
-    if isinstance(params, Parameters):
-        params = params.as_dict()
+    # Multi-stage?
+    if isinstance(params, (tuple, list)):
+        if not params:
+            raise ValueError('No parameters given.')
+        if im2 is None and len(params) > 1:
+            raise ValueError('Groupwise registration cannot have '
+                             'multiple stages.')
+        stages = [_get_stage_params(p, refIm, exact_params) for p in params]
+    else:
+        stages = [_get_stage_params(params, refIm, exact_params)]
+    
+    # Only the last stage needs to produce the result image
+    for params in stages[:-1]:
+        params['WriteResultImage'] = False
     
     # Groupwise?
+    params = stages[0]
     if im2 is None:
         # todo: also allow using a constraint on the "last dimension"
-        if not isinstance(im1, (tuple,list)):
-            raise ValueError('im2 is None, but im1 is not a list.')
-        #
-        ims = im1
-        ndim = ims[0].ndim
-        # Create new image that is a combination of all images
-        N = len(ims)
-        new_shape = (N,) + ims[0].shape
-        im1 = np.zeros(new_shape, ims[0].dtype)
-        for i in range(N):
-            im1[i] = ims[i]
+        ndim = refIm.ndim
         # Set parameters
         #params['UseCyclicTransform'] = True # to be chosen by user
-        params['FixedImageDimension'] = im1.ndim
-        params['MovingImageDimension'] = im1.ndim
+        params['FixedImageDimension'] = ndim + 1
+        params['MovingImageDimension'] = ndim + 1
         params['FixedImagePyramid'] = 'FixedSmoothingImagePyramid'
         params['MovingImagePyramid'] = 'MovingSmoothingImagePyramid'
         params['Metric'] = 'VarianceOverLastDimensionMetric'
@@ -512,81 +1767,796 @@ def register(im1, im2, params, exact_params=False, verbose=1):
         pyramidsamples.reverse()
         params['ImagePyramidSchedule'] = pyramidsamples
     
-    # Get paths of input images
-    path_im1, path_im2 = _get_image_paths(im1, im2)
+    # Let Elastix compress the result image?
+    if _compress_results:
+        stages[-1].setdefault('CompressResultImage', True)
+    
+    return im1, stages
+
+
+def _get_stage_params(params, refIm, exact_params):
+    """ Get the dictionary of parameters of a single stage.
+    """
+    if not exact_params:
+        params = _compile_params(params, refIm)
+    if isinstance(params, Parameters):
+        params = params.as_dict()
+    return dict(params)
+
+
+def _peek_frames(frames):
+    """ Get the first image of the input of a groupwise registration (a
+    list, iterator or stacked array of images). Returns `(first, frames)`,
+    where `frames` is a new iterator if the input is an iterator.
+    """
+    if isinstance(frames, (tuple, list)):
+        pass
+    elif isinstance(frames, np.ndarray):
+        if frames.ndim < 3:
+            raise ValueError('im2 is None, but im1 is not a stack of '
+                             'images.')
+    elif isinstance(frames, str) or not hasattr(frames, '__iter__'):
+        raise ValueError('im2 is None, but im1 is not a list.')
+    else:
+        frames = iter(frames)
+        try:
+            first = next(frames)
+        except StopIteration:
+            raise ValueError('No images given for groupwise registration.')
+        return first, itertools.chain([first], frames)
+    if not len(frames):
+        raise ValueError('No images given for groupwise registration.')
+    return frames[0], frames
+
+
+def _prepare_registration(im1, im2, params, workspace, outdir=None,
+                          report=None, initial_transform=None,
+                          masks=(None, None)):
+    """ Write the images and parameters of each stage (as obtained with
+    `_get_registration_params()`) of a registration, and the fixed and
+    moving masks (as obtained with `_get_mask()`) to the given
+    Workspace. Returns the list of commands to execute; the first calls
+    Elastix (with a parameter file per stage), the second calls
+    Transformix to get the deformation field. The output is written to
+    `outdir` (default the workspace). The files of the initial
+    Transform (if given) are written to `outdir` as well, because the
+    resulting transform refers to them.
+    """
+    outdir = outdir or workspace.path
+    
+    with _measure(report, 'write_images'):
+        # Groupwise? Write a new image that is a combination of all images
+        if im2 is None and not isinstance(im1, np.ndarray):
+            im1 = _write_frames(im1, 1, workspace)
+        # Get paths of input images
+        path_im1, path_im2 = _get_image_paths(im1, im2, workspace)
+        # Masks are written as images 3 and 4
+        paths_masks = []
+        for id, mask in enumerate(masks, 3):
+            if isinstance(mask, np.ndarray):
+                mask = _write_image_data(mask, id, workspace)
+            paths_masks.append(mask)
     
-    # Determine path of parameter file and write params
-    path_params = _write_parameter_file(params)
+    # Determine paths of parameter files and write params
+    with _measure(report, 'write_params'):
+        if len(params) == 1:
+            paths_params = [_write_parameter_file(params[0], workspace)]
+        else:
+            paths_params = [_write_parameter_file(p, workspace,
+                                                  'params.%i.txt' % i)
+                            for i, p in enumerate(params)]
     
-    # Get path of trafo param file
-    path_trafo_params = os.path.join(tempdir, 'TransformParameters.0.txt')
+    if report is not None:
+        report.bytes_written += sum(
+            os.path.getsize(os.path.join(workspace, fname))
+            for fname in os.listdir(workspace))
     
-    # Register
-    if True:
-        # Compile command to execute
-        command = [get_elastix_exes()[0],
-                   '-m', path_im1,
-                   '-f', path_im2,
-                   '-out', tempdir,
-                   '-p', path_params]
-        if verbose:
-            print("Calling Elastix to register images ...")
-        _system3(command, verbose)
-        
-        # Try and load result
-        try:
-            a = _read_image_data('result.0.mhd')
-        except IOError as why:
-            tmp = "An error occured during registration: " + str(why)
-            raise RuntimeError(tmp)
+    # Get path of trafo param file (of the last stage)
+    path_trafo_params = os.path.join(
+        outdir, 'TransformParameters.%i.txt' % (len(params) - 1))
     
-    # Find deformation field
-    if True:
-        # Compile command to execute
-        command = [get_elastix_exes()[1],
-                   '-def', 'all',
-                   '-out', tempdir,
-                   '-tp', path_trafo_params]
-        _system3(command, verbose)
-        
-        # Try and load result
-        try:
-            b = _read_image_data('deformationField.mhd')
-        except IOError as why:
-            tmp = "An error occured during transformation: " + str(why)
-            raise RuntimeError(tmp)
+    # Compile commands to execute
+    command1 = [get_elastix_exes()[0],
+                '-m', path_im1,
+                '-f', path_im2,
+                '-out', outdir]
+    for path_params in paths_params:
+        command1 += ['-p', path_params]
+    for arg, path_mask in zip(('-fMask', '-mMask'), paths_masks):
+        if path_mask is not None:
+            command1 += [arg, path_mask]
+    if initial_transform is not None:
+        command1 += ['-t0', initial_transform._write(outdir)]
+    command2 = [get_elastix_exes()[1],
+                '-def', 'all',
+                '-out', outdir,
+                '-tp', path_trafo_params]
+    return [command1, command2]
+
+
+def _get_mask(mask, im, name):
+    """ Check the given mask (an array or file location) of the given
+    image. Returns a uint8 array (with the sampling and origin of the
+    image), the file location, or None.
+    """
+    if mask is None or isinstance(mask, str):
+        if mask is not None and not os.path.isfile(mask):
+            raise ValueError('%s location does not exist.' % name)
+        return mask
+    mask = np.asarray(mask)
+    if isinstance(im, np.ndarray) and mask.shape != im.shape:
+        raise ValueError('The shape of %s %s does not match the image %s.'
+                         % (name, mask.shape, im.shape))
+    # Elastix wants unsigned char masks; bools can be viewed as such
+    if mask.dtype == np.bool_:
+        mask = np.ascontiguousarray(mask).view(np.uint8)
+    elif mask.dtype != np.uint8:
+        mask = (mask != 0).view(np.uint8)
+    mask = Image(mask)
+    for key in ('sampling', 'origin'):
+        if hasattr(im, key):
+            setattr(mask, key, getattr(im, key))
+    return mask
+
+
+def _get_early_stop_command(commands, outdir, path_tp, stage=0):
+    """ Get the command to apply the transform in the given file (of the
+    best iteration of a registration that was stopped early), which is
+    made the final transform (of the given stage). The result image is
+    written as result.mhd. The field is also computed if the given
+    commands include Transformix.
+    """
+    path_trafo_params = os.path.join(outdir,
+                                     'TransformParameters.%i.txt' % stage)
+    os.replace(path_tp, path_trafo_params)
+    path_im1 = commands[0][commands[0].index('-m') + 1]
+    command = [get_elastix_exes()[1],
+               '-in', path_im1,
+               '-out', outdir,
+               '-tp', path_trafo_params]
+    if len(commands) > 1:
+        command += ['-def', 'all']
+    return command
+
+
+def _finish_registration(tempdir, groupwise, mmap=False, out=None,
+                         layout='split', dtype=None, downsample=1,
+                         report=None, stage=0):
+    """ Load the results of a registration from the given directory.
+    Returns `(im1_deformed, field)`. The field is returned in the given
+    layout (see `_split_fields()`). The `stage` is the index of the last
+    stage of a multi-stage registration.
+    """
+    im_out, field_out = out or (None, None)
+    result = 'result.%i.' % stage
+    with _measure(report, 'read_image'):
+        a = _read_result(result + 'mhd', tempdir, 'registration', mmap,
+                         im_out)
+    with _measure(report, 'read_field'):
+        if os.path.isfile(os.path.join(tempdir, 'deformationField.mhd')):
+            # If the field is copied anyway, map the file to only load the
+            # data that is needed
+            copy = (layout in ('contiguous', 'magnitude') or
+                    dtype is not None or downsample > 1)
+            b = _read_result('deformationField.mhd', tempdir,
+                             'transformation',
+                             mmap or (copy and field_out is None), field_out)
+        else:
+            # Transformix was not used; evaluate (only the needed part of)
+            # the field here
+            texts = _get_transform(tempdir, stage)._texts
+            region = None
+            if downsample > 1:
+                ndim = len(_parse_parameters(texts[-1])['Size'])
+                region = (slice(None, None, downsample), ) * ndim
+            b = _evaluate_field(texts, region, out=field_out)
+            downsample = 1
+        field = _split_fields(b, groupwise, layout, dtype, downsample)
+    
+    if report is not None:
+        report.bytes_read += sum(
+            os.path.getsize(os.path.join(tempdir, fname))
+            for fname in os.listdir(tempdir)
+            if fname.startswith((result, 'deformationField.')))
+    return a, field
+
+
+def _get_transform(tempdir, stage=0):
+    """ Get the Transform object from the output of a registration (with
+    the given index of the last stage).
+    """
+    return Transform.from_file(
+        os.path.join(tempdir, 'TransformParameters.%i.txt' % stage))
+
+
+def _read_result(mhd_file, tempdir, what, mmap=False, out=None):
+    """ Read result image data, turning failure into a RuntimeError.
+    """
+    try:
+        return _read_image_data(mhd_file, tempdir, mmap, out)
+    except IOError as why:
+        tmp = "An error occured during %s: %s" % (what, why)
+        raise RuntimeError(tmp)
+
+
+# The forms in which the deformation field can be returned
+FIELD_LAYOUTS = ['split', 'contiguous', 'stacked', 'magnitude']
+
+
+def _get_field_kwargs(layout, dtype, downsample):
+    """ Check the arguments that specify the form of the deformation
+    field, and return them as a dict for `_finish_registration()`.
+    """
+    if layout not in FIELD_LAYOUTS:
+        raise ValueError('Invalid field_layout %r.' % layout)
+    if dtype is not None:
+        dtype = np.dtype(dtype)
+        if dtype.kind != 'f':
+            raise ValueError('field_dtype must be a float type.')
+    if int(downsample) != downsample or downsample < 1:
+        raise ValueError('field_downsample must be a positive integer.')
+    return dict(layout=layout, dtype=dtype, downsample=int(downsample))
+
+
+def _split_fields(b, groupwise, layout='split', dtype=None, downsample=1):
+    """ Pull apart the deformation field data produced by Transformix
+    into a tuple of arrays (one per dimension), or into another layout
+    (see `register()`). For groupwise registration, returns a list of
+    such fields.
+    """
     
     # Get deformation fields (for each image)
-    if im2 is None:
+    if groupwise:
         fields = [b[i] for i in range(b.shape[0])]
     else:
         fields = [b]
     
-    # Pull apart deformation fields in multiple images
+    # Get sampling and origin of the (downsampled) fields
+    ndim = b.ndim - 1 - bool(groupwise)
+    sampling = list(getattr(b, 'sampling', [1.0] * b.ndim))
+    origin = list(getattr(b, 'origin', [0.0] * b.ndim))
+    sampling = [s * downsample for s in sampling[-ndim - 1:-1]]
+    origin = origin[-ndim - 1:-1]
+    
+    # Pull apart deformation fields in multiple images. For groupwise
+    # registration, the field has a component for the extra dimension,
+    # which is dropped.
     for i in range(len(fields)):
         field = fields[i]
-        if field.ndim == 2:
-            field = [field[:, d] for d in range(1)]
-        elif field.ndim == 3:
-            field = [field[:, :, d] for d in range(2)]
-        elif field.ndim == 4:
-            field = [field[:, :, :, d] for d in range(3)]
-        elif field.ndim == 5:
-            field = [field[:, :, :, :, d] for d in range(4)]
-        fields[i] = tuple(field)
-    
-    if im2 is not None:
+        if downsample > 1:
+            field = field[(slice(None, None, downsample), ) * ndim]
+        field = field[..., :ndim]
+        if layout == 'magnitude':
+            field = _get_magnitude(field, dtype)
+        elif layout == 'contiguous':
+            field = tuple(np.ascontiguousarray(field[..., d], dtype)
+                          for d in range(ndim))
+        else:
+            # Make a copy if the result would otherwise be much smaller
+            # than the array it is a view of
+            if dtype is not None or downsample > 1:
+                field = field.astype(dtype or field.dtype)
+            if layout == 'split':
+                field = tuple(field[..., d] for d in range(ndim))
+        if isinstance(field, tuple):
+            fields[i] = tuple(_set_sampling(f, sampling, origin)
+                              for f in field)
+        elif layout == 'stacked':
+            fields[i] = _set_sampling(field, sampling + [1.0], origin + [0])
+        else:
+            fields[i] = _set_sampling(field, sampling, origin)
+    
+    if not groupwise:
         fields = fields[0]  # For pairwise reg, return 1 field, not a list
+    return fields
+
+
+def _get_magnitude(field, dtype=None):
+    """ Get the length of the vectors in a field with the components
+    stacked in the last dimension. Computed per slice, to limit memory.
+    """
+    result = np.empty(field.shape[:-1], dtype or np.float32)
+    for i in range(field.shape[0]):
+        v = field[i].astype(np.float32)
+        result[i] = np.sqrt((v * v).sum(-1))
+    return result
+
+
+def _set_sampling(a, sampling, origin):
+    """ Turn an array into an Image with the given sampling and origin.
+    """
+    a = Image(a)
+    a.sampling = list(sampling)
+    a.origin = list(origin)
+    return a
+
+
+def _register_job(im1, im2, params, kwargs, exes, threads):
+    """ Perform a single registration in a worker process.
+    """
+    # Avoid that each worker searches for (and reports) the executables
+    EXES[:] = exes
+    # Each worker gets its share of the thread budget
+    if get_thread_budget() != threads:
+        set_thread_budget(*threads)
+    return register(im1, im2, params, **kwargs)
+
+
+def register_many(pairs, params, max_workers=None, **kwargs):
+    """ register_many(pairs, params, max_workers=None, **kwargs)
+    
+    Perform many registrations in parallel. Each registration runs in
+    a separate worker process, and thereby has its own temporary
+    directory. Returns a generator that yields `(index, result, error)`
+    for each pair as soon as its registration finishes (i.e. not
+    necessarily in order). The `result` is the `(im1_deformed, field)`
+    tuple that `register()` returns, or None if the registration
+    failed, in which case `error` is the exception that occurred. A
+    failing registration does not stop the others.
+    
+    Parameters:
+    
+    * pairs (iterable):
+        The `(im1, im2)` pairs to register. Can be a generator, so that
+        not all images need to be in memory at the same time.
+    * params (dict or Parameters):
+        The parameters of the registration, used for all pairs.
+    * max_workers (int):
+        The number of registrations to run at the same time. Default
+        is the number of processors on the machine.
+    * kwargs:
+        Further keyword arguments are passed to `register()`. Note that
+        `verbose` is zero by default.
+    
+    The thread budget (see `set_thread_budget()`), or the number of
+    processors if there is none, is divided between the workers, so
+    that the Elastix processes do not oversubscribe the CPU.
+    """
+    
+    kwargs.setdefault('verbose', 0)
+    max_workers = max_workers or os.cpu_count() or 1
+    
+    # Find executables here, so we fail early and workers don't search
+    exes = list(get_elastix_exes())
+    
+    # Divide the threads between the workers
+    total, per_job = get_thread_budget()
+    share = max(1, (total or os.cpu_count() or 1) // max_workers)
+    threads = share, min(per_job or share, share)
+    
+    pairs = enumerate(pairs)
+    pending = {}
+    with _futures.ProcessPoolExecutor(max_workers) as executor:
+        while True:
+            # Keep a limited number of jobs queued, to bound memory usage
+            while len(pending) < 2 * max_workers:
+                try:
+                    index, (im1, im2) = next(pairs)
+                except StopIteration:
+                    break
+                future = executor.submit(_register_job, im1, im2, params,
+                                         kwargs, exes, threads)
+                pending[future] = index
+            if not pending:
+                break
+            # Yield results as they come in
+            done, _ = _futures.wait(pending,
+                                    return_when=_futures.FIRST_COMPLETED)
+            for future in done:
+                index = pending.pop(future)
+                error = future.exception()
+                if error is None:
+                    yield index, future.result(), None
+                else:
+                    yield index, None, error
+
+
+def register_sequence(frames, reference, params, warm_params=None,
+                      max_chain=8, **kwargs):
+    """ register_sequence(frames, reference, params, warm_params=None, ...)
+    
+    Register each frame of a sequence (e.g. a 2D+t or 3D+t series) to
+    the reference image, starting each registration from the transform
+    of the previous frame (passed to Elastix as initial transform), since
+    consecutive frames usually move in much the same way. Returns a
+    generator that yields the result of `register()` for each frame, as
+    soon as it is available. The frames are taken from the given
+    iterable one at a time, so it can be a generator that loads each
+    frame, to not hold the whole sequence in memory.
+    
+    Parameters:
+    
+    * frames (iterable):
+        The moving images (ndarrays or file locations).
+    * reference (ndarray or file location):
+        The static (reference) image.
+    * params (dict or Parameters):
+        The parameters of the registration of the first frame (or a
+        list, for a multi-stage registration).
+    * warm_params (dict or Parameters):
+        The parameters of the registration of the next frames, which
+        start from the previous transform. By default, these are `params`
+        (or its last stage) with half the number of resolutions and
+        iterations.
+    * max_chain (int):
+        Each transform is a chain that starts with the transform of the
+        previous frame. When the chain would become longer than this,
+        the frame is registered from scratch with `params` instead, so
+        that the transforms remain cheap to apply. Default 8.
+    * kwargs:
+        Further keyword arguments are passed to `register()`. Note that
+        `verbose` is zero by default.
+    """
+    
+    kwargs.setdefault('verbose', 0)
+    return_transform = kwargs.pop('return_transform', False)
+    if kwargs.get('initial_transform') is not None:
+        raise ValueError('register_sequence() sets the initial transform.')
+    if warm_params is None:
+        warm_params = _get_warm_params(params)
+    n_warm = len(warm_params) if isinstance(warm_params, (tuple, list)) else 1
+    
+    transform = None
+    for im in frames:
+        if transform is None or len(transform._texts) + n_warm > max_chain:
+            result = register(im, reference, params, return_transform=True,
+                              **kwargs)
+        else:
+            result = register(im, reference, warm_params,
+                              return_transform=True,
+                              initial_transform=transform, **kwargs)
+        transform = result[-1]
+        yield result if return_transform else result[:-1]
+
+
+def _get_warm_params(params):
+    """ Get the parameters for a registration that starts from the result
+    of a similar registration: the last stage, with half the number of
+    resolutions and iterations.
+    """
+    if isinstance(params, (tuple, list)):
+        params = params[-1]
+    if isinstance(params, Parameters):
+        params = params.as_dict()
+    params = dict(params)
+    p = Parameters()
     
-    # Clean and return
-    _clear_temp_dir()
-    return a, fields
+    n = max(1, int(params.get('NumberOfResolutions', 4)) // 2)
+    params['NumberOfResolutions'] = n
+    iterations = params.get('MaximumNumberOfIterations', 500)
+    if isinstance(iterations, (tuple, list)):
+        iterations = [max(1, int(i) // 2) for i in iterations[-n:]]
+    else:
+        iterations = max(1, int(iterations) // 2)
+    params['MaximumNumberOfIterations'] = iterations
+    
+    # Do not move the initial transform to the center again, and remove
+    # schedules for the original number of resolutions
+    if 'AutomaticTransformInitialization' in params:
+        params['AutomaticTransformInitialization'] = False
+    for key in ('ImagePyramidSchedule', 'FixedImagePyramidSchedule',
+                'MovingImagePyramidSchedule', 'GridSpacingSchedule'):
+        params.pop(key, None)
+    p.__dict__.update(params)
+    return p
+
+
+# Arguments of register() that do not apply to the tiles
+_TILED_UNSUPPORTED = ('field_layout', 'field_downsample', 'output_dir',
+                      'workspace', 'return_transform', 'mmap')
+
+
+def register_tiled(im1, im2, params, tile_size=2048, overlap=256,
+                   coarse_factor=8, coarse_params=None, max_workers=None,
+                   out=None, **kwargs):
+    """ register_tiled(im1, im2, params, tile_size=2048, overlap=256, ...)
+    
+    Perform the registration of `im1` to `im2` in overlapping tiles, for
+    images that are too large to register at once (e.g. whole-slide
+    histology images). First, a coarse (affine) registration of a
+    downsampled version of the images is performed. Then the tiles are
+    registered in parallel (see `register_many()`), each starting from
+    the coarse transform. Finally, the results of the tiles are blended
+    (with weights that go linearly from one tile to the next in the
+    overlap) into one seamless deformation field and deformed image.
+    Returns `(im1_deformed, field)`, like `register()`; the deformed
+    image is float32.
+    
+    The images are only read a tile at a time (so they can be e.g. an
+    `np.memmap`), and the results are written to memory mapped
+    temporary files (or to `out`), so that the memory use scales with
+    the size of the tiles rather than that of the images. The files are
+    removed when the results are no longer used.
+    
+    Parameters:
+    
+    * im1 (ndarray):
+        The moving image (the one to deform).
+    * im2 (ndarray):
+        The static (reference) image, which is divided in tiles.
+    * params (dict or Parameters):
+        The parameters of the registration of each tile (or a list, for
+        a multi-stage registration).
+    * tile_size (int or tuple):
+        The size of the tiles (for each dimension), including the
+        overlap. Default 2048.
+    * overlap (int):
+        The overlap between neighbouring tiles. The tile size must be
+        at least twice the overlap. The moving tiles are extended with
+        this margin as well. Default 256.
+    * coarse_factor (int):
+        The factor to downsample the images with for the coarse
+        registration, or None to skip it. Default 8.
+    * coarse_params (dict or Parameters):
+        The parameters of the coarse registration. By default, those of
+        `get_default_params('AFFINE')`.
+    * max_workers (int):
+        The number of tiles to register at the same time. Default
+        is the number of processors on the machine.
+    * out (tuple):
+        Optional `(im_out, field_out)` tuple of arrays (e.g. `np.memmap`)
+        to write the result to: a float32 array with the shape of `im2`
+        and one with an extra dimension for the components of the field
+        (in x-y-z order).
+    * kwargs:
+        Further keyword arguments are passed to `register()` for the
+        tiles (and the coarse registration). An `initial_transform` is
+        applied before the coarse registration. Arguments that determine
+        the form of the result (such as `field_layout` and `output_dir`)
+        are not supported.
+    """
+    
+    ndim = im2.ndim
+    shape = im2.shape
+    if im1.shape != shape:
+        raise ValueError('The images must have the same shape.')
+    for key in _TILED_UNSUPPORTED:
+        if key in kwargs:
+            raise TypeError('register_tiled() does not support the %r '
+                            'argument.' % key)
+    if isinstance(tile_size, int):
+        tile_size = (tile_size, ) * ndim
+    if min(tile_size) < 2 * overlap or overlap < 0:
+        raise ValueError('The tile size must be at least twice the overlap.')
+    kwargs.setdefault('verbose', 0)
+    
+    # Coarse registration, on a downsampled version of the images
+    initial = kwargs.pop('initial_transform', None)
+    if coarse_factor:
+        if coarse_params is None:
+            coarse_params = get_default_params('AFFINE')
+        step = (slice(None, None, coarse_factor), ) * ndim
+        result = register(_get_tile(im1, step), _get_tile(im2, step),
+                          coarse_params, return_transform=True,
+                          initial_transform=initial, **kwargs)
+        initial = result[-1]
+    
+    # Prepare output. The workspace is closed when both results are no
+    # longer used. On Windows, files that are still mapped at that moment
+    # are removed at exit instead.
+    if out is None:
+        workspace = Workspace()
+        im_out = np.memmap(os.path.join(workspace.path, 'result.raw'),
+                           np.float32, 'w+', shape=shape)
+        field_out = np.memmap(os.path.join(workspace.path, 'field.raw'),
+                              np.float32, 'w+', shape=shape + (ndim, ))
+        finalized = itertools.count(1)
+        for a in (im_out, field_out):
+            weakref.finalize(
+                a, lambda: next(finalized) == 2 and workspace.close())
+    else:
+        im_out, field_out = out
+        if im_out.shape != shape or field_out.shape != shape + (ndim, ):
+            raise ValueError('Output arrays must have shape %s and %s.'
+                             % (shape, shape + (ndim, )))
+        im_out[...] = 0
+        field_out[...] = 0
+    
+    # Register the tiles, and blend the results into the output
+    regions = _get_tile_regions(shape, tile_size, overlap)
+    pairs = ((_get_moving_tile(im1, im2, region, overlap, initial),
+              _get_tile(im2, region)) for region in regions)
+    for index, result, error in register_many(
+            pairs, params, max_workers, field_layout='stacked',
+            initial_transform=initial, **kwargs):
+        if error is not None:
+            raise RuntimeError('Registration of tile %i failed: %s' %
+                               (index, error))
+        region = regions[index]
+        weights = _get_tile_weights(region, shape, overlap)
+        im_out[region] += weights * result[0]
+        field_out[region] += weights[..., None] * result[1]
+    
+    # Return as Images, with the field split per dimension
+    im_out = _set_sampling(im_out, getattr(im2, 'sampling', [1.0] * ndim),
+                           getattr(im2, 'origin', [0.0] * ndim))
+    field = _set_sampling(field_out, list(im_out.sampling) + [1.0],
+                          list(im_out.origin) + [0])
+    return im_out, _split_fields(field, False)
+
+
+def _get_tile_regions(shape, tile_size, overlap):
+    """ Get the regions (tuples of slices) of the tiles that cover an
+    image of the given shape. Neighbouring tiles overlap by exactly
+    `overlap` samples, and other tiles do not overlap.
+    """
+    ranges = []
+    for n, size in zip(shape, tile_size):
+        step = size - overlap
+        starts = range(0, max(n - overlap, 1), step)
+        ranges.append([slice(i, min(i + size, n)) for i in starts])
+    return list(itertools.product(*ranges))
+
+
+def _get_tile_weights(region, shape, overlap):
+    """ Get the weights to blend the result of a tile with, which go
+    linearly from 1 to 0 in the overlap with the next tile (and from 0
+    to 1 in the overlap with the previous tile). Because the tiles
+    overlap by exactly `overlap`, the weights of all tiles sum to one.
+    """
+    weights = np.ones((), np.float32)
+    ramp = (np.arange(overlap, dtype=np.float32) + 0.5) / max(overlap, 1)
+    for s, n in zip(region, shape):
+        w = np.ones(s.stop - s.start, np.float32)
+        if s.start > 0:
+            w[:overlap] = ramp
+        if s.stop < n:
+            w[len(w) - overlap:] = ramp[::-1]
+        weights = weights[..., None] * w
+    return weights
+
+
+def _get_tile(im, region):
+    """ Get the given region of an image, as an Image with the
+    corresponding sampling and origin. Does not copy the data.
+    """
+    sampling = list(getattr(im, 'sampling', [1.0] * im.ndim))
+    origin = list(getattr(im, 'origin', [0.0] * im.ndim))
+    for d, s in enumerate(region):
+        start, _, step = s.indices(im.shape[d])
+        origin[d] += start * sampling[d]
+        sampling[d] *= step
+    return _set_sampling(im[region], sampling, origin)
 
 
-def _write_image_data(im, id):
-    """ Write a numpy array to disk in the form of a .raw and .mhd file.
-    The id is the image sequence number (1 or 2). Returns the path of
-    the mhd file.
+def _get_moving_tile(im1, im2, region, margin, transform=None):
+    """ Get the region of the moving image that corresponds to the given
+    region of the fixed image, according to the given transform (if it
+    can be evaluated with numpy), extended with a margin.
+    """
+    # Get the corners of the fixed region in world coordinates (x-y-z)
+    fixed = _get_tile(im2, region)
+    sampling = np.array(fixed.sampling[::-1], np.float64)
+    origin = np.array(fixed.origin[::-1], np.float64)
+    corners = np.array(list(itertools.product(
+        *[(0, n - 1) for n in fixed.shape[::-1]])), np.float64)
+    points = origin + corners * sampling
+    if transform is not None and transform.can_evaluate():
+        points = transform_points(transform, points, 'numpy')
+    
+    # Get the bounding box in the moving image
+    sampling = np.array(getattr(im1, 'sampling', [1.0] * im1.ndim))
+    origin = np.array(getattr(im1, 'origin', [0.0] * im1.ndim))
+    index = (points[:, ::-1] - origin) / sampling
+    lower = np.floor(index.min(0)).astype(int) - margin
+    upper = np.ceil(index.max(0)).astype(int) + margin + 1
+    lower = np.clip(lower, 0, im1.shape)
+    upper = np.clip(upper, 0, im1.shape)
+    if (upper <= lower).any():
+        return _get_tile(im1, region)  # Maps outside of the image
+    return _get_tile(im1, tuple(slice(a, b) for a, b in zip(lower, upper)))
+
+
+_compression_level = 0
+_compress_results = False
+
+
+def set_compression(level, compress_results=True):
+    """ set_compression(level, compress_results=True)
+    
+    Set the zlib compression level (1-9) of the images that are written
+    for Elastix, or 0 to write them uncompressed (the default). This
+    reduces the amount of data to move when the temporary directory is
+    on a (slow) network file system, especially for images with large
+    uniform regions, such as masks and label maps. The data is
+    compressed in chunks, in parallel. Memory mapped images are still
+    referred to directly (see `register()`).
+    
+    If `compress_results` is True, Elastix is also asked to compress
+    the result image (using the CompressResultImage parameter).
+    """
+    global _compression_level, _compress_results
+    level = int(level)
+    if not 0 <= level <= 9:
+        raise ValueError('Compression level must be between 0 and 9.')
+    _compression_level = level
+    _compress_results = bool(level and compress_results)
+
+
+def _compress_data(data, level, chunk=2 ** 22):
+    """ Compress the given bytes-like object into a zlib stream, as a
+    list of bytes objects. The chunks are compressed by a thread pool
+    (zlib releases the GIL). Each is a raw deflate stream that ends in
+    a sync flush (except the last), so they can simply be concatenated.
+    """
+    data = memoryview(data).cast('B')
+    chunks = [data[i:i + chunk] for i in range(0, len(data), chunk)]
+    chunks = chunks or [data]
+    
+    def compress(i):
+        c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        if i == len(chunks) - 1:
+            return c.compress(chunks[i]) + c.flush(zlib.Z_FINISH)
+        return c.compress(chunks[i]) + c.flush(zlib.Z_SYNC_FLUSH)
+    
+    if len(chunks) == 1:
+        parts = [compress(0)]
+    else:
+        n = min(len(chunks), os.cpu_count() or 1)
+        with _futures.ThreadPoolExecutor(n) as pool:
+            parts = list(pool.map(compress, range(len(chunks))))
+    
+    # Wrap in zlib header and (adler32) checksum
+    checksum = 1
+    for c in chunks:
+        checksum = zlib.adler32(c, checksum)
+    return [b'\x78\x9c'] + parts + [struct.pack('>I', checksum)]
+
+
+def _decompress_into(fname, a):
+    """ Decompress the data of a zlib (or gzip) file into the given
+    C-contiguous array, without holding the compressed data in memory.
+    """
+    target = memoryview(a).cast('B')
+    d = zlib.decompressobj(32 + zlib.MAX_WBITS)  # Detect header
+    pos = 0
+    with open(fname, 'rb') as f:
+        while not d.eof:
+            block = f.read(2 ** 20)
+            if not block:
+                break
+            while block:
+                data = d.decompress(block, 2 ** 22)
+                if pos + len(data) > len(target):
+                    raise IOError('Too much data in ' + fname)
+                target[pos:pos + len(data)] = data
+                pos += len(data)
+                block = d.unconsumed_tail
+    if pos != len(target):
+        raise IOError('Could not read all data from ' + fname)
+
+
+def _get_file_location(im):
+    """ If the given array maps (a C-contiguous part of) a file, i.e. it
+    is an np.memmap or a view of one, return `(filename, offset)`, with
+    offset the position of the data in the file in bytes. Otherwise
+    return None.
+    """
+    # Get the memmap object that holds the mmap
+    base = im
+    while isinstance(base, np.ndarray):
+        if isinstance(base.base, mmap.mmap):
+            break
+        base = base.base
+    if not isinstance(base, np.memmap) or not base.filename:
+        return None
+    # Check that the file holds the data in the layout that we need. With
+    # mode "c", any changes that were made to the array are not in the file.
+    if not im.flags.c_contiguous or im.dtype.str[0] not in '<|':
+        return None
+    elif base.mode == 'c':
+        return None
+    offset = base.offset + (im.ctypes.data - base.ctypes.data)
+    return base.filename, offset
+
+
+def _write_image_data(im, id, workspace=None):
+    """ Write a numpy array to disk in the form of a .raw and .mhd file,
+    in the given Workspace (or directory). The id is the image sequence
+    number (1 or 2). Returns the path of
+    the mhd file. If the array is a memory mapped file, only the mhd
+    file is written, which refers to the existing file. Otherwise the
+    data is compressed if enabled with `set_compression()`.
     """
     # im = im * (1.0/3000)  # TODO: WTF is this?
     # Create text
@@ -608,11 +2578,22 @@ def _write_image_data(im, id):
     text = '\n'.join(lines)
     
     # Determine file names
-    tempdir = get_tempdir()
+    tempdir = os.fspath(workspace or get_tempdir())
     fname_raw_ = 'im%i.raw' % id
     fname_raw = os.path.join(tempdir, fname_raw_)
     fname_mhd = os.path.join(tempdir, 'im%i.mhd' % id)
     
+    # If the data is already in a file, refer to that instead of copying
+    location = _get_file_location(im)
+    if location is not None:
+        fname_raw, offset = location
+        fname_raw_ = os.path.abspath(fname_raw)
+        text = text.replace('ElementDataFile', 'HeaderSize = %i\n'
+                            'ElementDataFile' % offset)
+    elif _compression_level:
+        fname_raw_ = 'im%i.zraw' % id
+        fname_raw = os.path.join(tempdir, fname_raw_)
+    
     # Get shape, sampling and origin
     shape = im.shape
     if hasattr(im, 'sampling'):
@@ -650,13 +2631,23 @@ def _write_image_data(im, id):
         pass  # TODO: ???
     
     # Write data file
-    f = open(fname_raw, 'wb')
-    try:
-        f.write(im.data)
-    except:
-        f.write(np.ascontiguousarray(im.data))
-    finally:
-        f.close()
+    if location is None and _compression_level:
+        parts = _compress_data(np.ascontiguousarray(im), _compression_level)
+        text = text.replace('CompressedData = False', 'CompressedData = True\n'
+                            'CompressedDataSize = %i' % sum(map(len, parts)))
+        f = open(fname_raw, 'wb')
+        try:
+            f.writelines(parts)
+        finally:
+            f.close()
+    elif location is None:
+        f = open(fname_raw, 'wb')
+        try:
+            f.write(im.data)
+        except:
+            f.write(np.ascontiguousarray(im.data))
+        finally:
+            f.close()
     
     # Write mhd file
     f = open(fname_mhd, 'wb')
@@ -669,19 +2660,50 @@ def _write_image_data(im, id):
     return fname_mhd
 
 
-def _read_image_data(mhd_file):
+def _write_frames(frames, id, workspace=None):
+    """ Write an iterable of equally shaped arrays to disk as a single
+    stacked image (in the same way as `_write_image_data()`), one frame
+    at a time, so that the stack is never held in memory. Returns the
+    path of the mhd file.
+    """
+    tempdir = os.fspath(workspace or get_tempdir())
+    fname_raw = os.path.join(tempdir, 'im%i.raw' % id)
+    
+    # Write data file
+    first, n = None, 0
+    with open(fname_raw, 'wb') as f:
+        for frame in frames:
+            frame = np.asarray(frame)
+            if first is None:
+                first = frame
+            elif frame.shape != first.shape:
+                raise ValueError('All images must have the same shape.')
+            f.write(np.ascontiguousarray(frame, first.dtype).data)
+            n += 1
+    if first is None:
+        raise ValueError('No images given for groupwise registration.')
+    
+    # Write mhd file that describes the stack, which refers to the data file
+    stack = np.memmap(fname_raw, first.dtype, 'r', shape=(n, ) + first.shape)
+    return _write_image_data(stack, id, workspace)
+
+
+def _read_image_data(mhd_file, tempdir=None, mmap=False, out=None):
     """ Read the resulting image data and return it as a numpy array.
+    If mmap is True, the array maps the data file (copy-on-write, so
+    the array can be modified without changing the file). Otherwise,
+    the data is read into a new array, or into `out` if given. Compressed
+    data is always read into memory.
     """
-    tempdir = get_tempdir()
+    tempdir = os.fspath(tempdir or get_tempdir())
     
     # Load description from mhd file
-    fname = tempdir + '/' + mhd_file
+    fname = os.path.join(tempdir, mhd_file)
     des = open(fname, 'r').read()
     
-    # Get data filename and load raw data
+    # Get data filename
     match = re.findall('ElementDataFile = (.+?)\n', des)
-    fname = tempdir + '/' + match[0]
-    data = open(fname, 'rb').read()
+    fname = os.path.join(tempdir, match[0])
     
     # Determine dtype
     match = re.findall('ElementType = (.+?)\n', des)
@@ -689,9 +2711,19 @@ def _read_image_data(mhd_file):
     dtype = DTYPE_ITK2NP.get(dtype_itk, None)
     if dtype is None:
         raise RuntimeError('Unknown ElementType: ' + dtype_itk)
+    dtype = np.dtype(dtype)
     
-    # Create numpy array
-    a = np.frombuffer(data, dtype=dtype)
+    # Determine number of elements in the data file
+    match = re.findall('CompressedData = (.+?)\n', des)
+    compressed = bool(match) and match[0].strip().lower() == 'true'
+    if compressed:
+        match = re.findall('DimSize = (.+?)\n', des)
+        size = int(np.prod([int(i) for i in match[0].split()]))
+        match = re.findall('ElementNumberOfChannels = (.+?)\n', des)
+        size *= int(match[0]) if match else 1
+        mmap = False
+    else:
+        size = os.path.getsize(fname) // dtype.itemsize
     
     # Determine shape, sampling and origin of the data
     match = re.findall('DimSize = (.+?)\n', des)
@@ -704,27 +2736,47 @@ def _read_image_data(mhd_file):
     origin = [float(i) for i in match[0].split(' ')]
     
     # Reverse shape stuff to make z-y-x order
-    shape = [s for s in reversed(shape)]
+    shape = tuple(reversed(shape))
     sampling = [s for s in reversed(sampling)]
     origin = [s for s in reversed(origin)]
     
     # Take vectors/colours into account
     N = np.prod(shape)
-    if N != a.size:
-        extraDim = int(a.size / N)
+    if N != size:
+        extraDim = int(size / N)
         shape = tuple(shape) + (extraDim,)
         sampling = tuple(sampling) + (1.0,)
         origin = tuple(origin) + (0,)
     
     # Check shape
     N = np.prod(shape)
-    if N != a.size:
+    if N != size:
         raise RuntimeError('Cannot apply shape to data.')
+    
+    # Load the data
+    if mmap:
+        a = np.memmap(fname, dtype, 'c', shape=shape)
     else:
-        a.shape = shape
-        a = Image(a)
-        a.sampling = sampling
-        a.origin = origin
+        if out is None:
+            a = np.empty(shape, dtype)
+        elif out.dtype != dtype or out.size != N:
+            raise ValueError('Output array must have dtype %s and %i '
+                             'elements.' % (dtype.name, N))
+        elif not out.flags.c_contiguous:
+            raise ValueError('Output array must be C-contiguous.')
+        else:
+            a = out.reshape(shape)
+        if compressed:
+            _decompress_into(fname, a)
+        else:
+            with open(fname, 'rb') as f:
+                nbytes = f.readinto(memoryview(a).cast('B'))
+            if nbytes != a.nbytes:
+                raise IOError('Could not read all data from ' + fname)
+    
+    a = Image(a)
+    a.sampling = sampling
+    a.origin = origin
     return a
 
 
@@ -737,6 +2789,524 @@ class Image(np.ndarray):
             # Just return the original; no metadata on the array in Pypy!
             return array
         return ob
+    
+    def __reduce__(self):
+        # Include sampling and origin, so they survive e.g. being sent
+        # back from a worker process.
+        func, args, state = np.ndarray.__reduce__(self)[:3]
+        return func, args, (state, dict(getattr(self, '__dict__', {})))
+    
+    def __setstate__(self, state):
+        np.ndarray.__setstate__(self, state[0])
+        self.__dict__.update(state[1])
+
+
+# %% The Transform class
+
+
+class Transform:
+    """ Transform(texts)
+    
+    Object that represents a transform as found by Elastix, so that it
+    can be applied to other images, or stored for later use. The `texts`
+    are the contents of the Elastix transform parameter files (e.g.
+    "TransformParameters.0.txt"). If there are multiple, they form a
+    chain: each transform is applied on top of the previous one.
+    
+    A Transform is obtained from `register()` with `return_transform=True`,
+    or with `Transform.from_file()`.
+    """
+    
+    def __init__(self, texts):
+        if isinstance(texts, str):
+            texts = [texts]
+        self._texts = list(texts)
+    
+    def __repr__(self):
+        name = (self.get_parameter('Transform') or ['unknown'])[0]
+        return '<Transform %s with %i stage(s)>' % (name, len(self._texts))
+    
+    @classmethod
+    def from_file(cls, filename):
+        """ Create a Transform from an Elastix transform parameter file.
+        Initial transforms that the file refers to are loaded as well.
+        """
+        texts = []
+        while filename:
+            with open(filename, 'rb') as f:
+                text = f.read().decode('utf-8')
+            texts.insert(0, text)
+            # Follow the reference to the initial transform
+            key = 'InitialTransformParametersFileName'
+            initial = _get_parameter(text, key)
+            dirname = os.path.dirname(os.path.abspath(filename))
+            filename = None
+            if initial and initial[0] != 'NoInitialTransform':
+                filename = initial[0]
+                if not os.path.isfile(filename):
+                    # Relative, or moved along (e.g. to the result cache)
+                    filename = os.path.join(dirname,
+                                            os.path.basename(filename))
+        return cls(texts)
+    
+    def save(self, filename):
+        """ Save the transform as an Elastix transform parameter file.
+        Initial transforms (if any) are saved as separate files next to
+        it, to which the file refers.
+        """
+        filename = os.path.abspath(filename)
+        base, ext = os.path.splitext(filename)
+        filenames = ['%s_%i%s' % (base, i, ext)
+                     for i in range(len(self._texts) - 1)]
+        _write_transform_files(self._texts, filenames + [filename])
+    
+    def get_parameter(self, key, stage=-1):
+        """ Get the value of the given parameter of the transform, as
+        a list of values. The `stage` selects the transform in the chain
+        (default the last). Returns None if the parameter is not set.
+        """
+        return _get_parameter(self._texts[stage], key)
+    
+    def apply(self, images, order=None, verbose=0):
+        """ apply(images, order=None, verbose=0)
+        
+        Apply the transform to one or more images (ndarrays or file
+        locations), using Transformix. The images are sampled on the grid
+        of the fixed image of the registration. If `images` is a list,
+        returns a list of deformed images.
+        
+        The `order` specifies the interpolation order (0 for nearest
+        neighbour, 1 for linear, 3 for cubic). By default, it is 0 for
+        images of integer or bool type (e.g. label maps), and 3 otherwise.
+        """
+        
+        single = not isinstance(images, (tuple, list))
+        if single:
+            images = [images]
+        
+        with Workspace() as workspace:
+            results = []
+            for im in images:
+                texts = list(self._texts)
+                # Convert bool images, because ITK does not support them
+                is_bool = getattr(im, 'dtype', None) == np.bool_
+                if is_bool:
+                    im = im.astype(np.uint8)
+                # Set interpolation order and type of the result
+                if order is not None:
+                    im_order = order
+                elif isinstance(im, np.ndarray):
+                    im_order = 0 if im.dtype.kind in 'iu' else 3
+                else:
+                    im_order = 3
+                texts[-1] = _set_parameter(texts[-1],
+                                           'FinalBSplineInterpolationOrder',
+                                           im_order)
+                if isinstance(im, np.ndarray):
+                    tmp = DTYPE_NP2ITK[im.dtype.name]
+                    texts[-1] = _set_parameter(
+                        texts[-1], 'ResultImagePixelType',
+                        tmp.split('_')[-1].lower())
+                # Write files and apply
+                path_tp = self._write(workspace.path, texts)
+                path_im = _get_image_paths(im, None, workspace)[0]
+                command = [get_elastix_exes()[1],
+                           '-in', path_im,
+                           '-out', workspace.path,
+                           '-tp', path_tp]
+                _system3(command, verbose)
+                a = _read_result('result.mhd', workspace.path,
+                                 'transformation')
+                results.append(a.astype(bool) if is_bool else a)
+        
+        return results[0] if single else results
+    
+    def field(self, verbose=0, engine='transformix', region=None):
+        """ field(verbose=0, engine='transformix', region=None)
+        
+        Get the deformation field that corresponds to this transform, on
+        the grid of the fixed image. Returns a tuple with arrays describing
+        the deformation for each dimension (x-y-z order, in world units).
+        
+        The `engine` can be 'transformix' or 'numpy'. The latter evaluates
+        the transform in this process, which avoids writing and reading
+        the field to disk. It supports the Translation, Euler, Affine and
+        BSpline transforms (see `can_evaluate()`). If `region` is given
+        (a tuple of slices, in z-y-x order), only the field at that part
+        of the grid is returned. With the numpy engine, only that part is
+        evaluated, e.g. `(slice(None, None, 2), ) * ndim` evaluates the
+        field at half the resolution.
+        """
+        if engine == 'numpy':
+            if not self.can_evaluate():
+                raise ValueError('Cannot evaluate this transform with numpy.')
+            return _split_fields(_evaluate_field(self._texts, region), False)
+        elif engine != 'transformix':
+            raise ValueError('Invalid engine %r.' % engine)
+        
+        with Workspace() as workspace:
+            command = [get_elastix_exes()[1],
+                       '-def', 'all',
+                       '-out', workspace.path,
+                       '-tp', self._write(workspace.path)]
+            _system3(command, verbose)
+            b = _read_result('deformationField.mhd', workspace.path,
+                             'transformation')
+        if region is not None:
+            b = b[tuple(region)]
+        return _split_fields(b, False)
+    
+    def can_evaluate(self):
+        """ Get whether this transform can be evaluated with numpy, i.e.
+        without Transformix (see `field()` and `transform_points()`).
+        """
+        return _can_evaluate(self._texts)
+    
+    def transform_points(self, points, engine=None, verbose=0):
+        """ Apply this transform to the given points. Same as
+        `transform_points(transform, points, ...)`.
+        """
+        return transform_points(self, points, engine, verbose)
+    
+    def _write(self, dirname, texts=None):
+        """ Write the transform parameter files (or the given variant of
+        the texts) in the given directory. Returns the path of the last
+        file.
+        """
+        texts = texts or self._texts
+        filenames = [os.path.join(dirname, 'transform.%i.txt' % i)
+                     for i in range(len(texts))]
+        return _write_transform_files(texts, filenames)
+
+
+def transform_points(transform, points, engine=None, verbose=0):
+    """ transform_points(transform, points, engine=None, verbose=0)
+    
+    Apply a transform (a `Transform` object or the filename of a transform
+    parameter file) to the given points: an (N, ndim) array of world
+    coordinates in x-y-z order. Returns an (N, ndim) array. Note that
+    Elastix transforms map points in the fixed image to the moving image.
+    
+    The `engine` can be 'numpy' or 'transformix'. By default, numpy is
+    used if the transform is supported (see `Transform.can_evaluate()`).
+    Otherwise the points are passed to Transformix in large batches. In
+    both cases, no dense deformation field is computed.
+    """
+    if not isinstance(transform, Transform):
+        transform = Transform.from_file(transform)
+    points = np.asarray(points, np.float64)
+    if points.ndim != 2:
+        raise ValueError('Points must be an (N, ndim) array.')
+    if engine is None:
+        engine = 'numpy' if transform.can_evaluate() else 'transformix'
+    
+    result = np.empty_like(points)
+    if engine == 'numpy':
+        if not transform.can_evaluate():
+            raise ValueError('Cannot evaluate this transform with numpy.')
+        chunk = 2 ** 16
+        for i in range(0, len(points), chunk):
+            result[i:i + chunk] = _evaluate_points(transform._texts,
+                                                   points[i:i + chunk])
+    elif engine == 'transformix':
+        chunk = 2 ** 20
+        with Workspace() as workspace:
+            path_tp = transform._write(workspace.path)
+            for i in range(0, len(points), chunk):
+                result[i:i + chunk] = _transformix_points(
+                    path_tp, points[i:i + chunk], workspace.path, verbose)
+    else:
+        raise ValueError('Invalid engine %r.' % engine)
+    return result
+
+
+def _transformix_points(path_tp, points, tempdir, verbose=0):
+    """ Transform the given points with Transformix.
+    """
+    
+    # Write points file
+    path_points = os.path.join(tempdir, 'points.txt')
+    with open(path_points, 'wb') as f:
+        f.write(('point\n%i\n' % len(points)).encode())
+        np.savetxt(f, points, '%.17g')
+    
+    # Apply
+    command = [get_elastix_exes()[1],
+               '-def', path_points,
+               '-out', tempdir,
+               '-tp', path_tp]
+    _system3(command, verbose)
+    
+    # Read the output points
+    with open(os.path.join(tempdir, 'outputpoints.txt'), 'rb') as f:
+        text = f.read().decode()
+    values = re.findall(r'OutputPoint = \[([^\]]*)\]', text)
+    if len(values) != len(points):
+        raise RuntimeError('An error occured during transformation: '
+                           'expected %i points, got %i.'
+                           % (len(points), len(values)))
+    return np.array([v.split() for v in values], np.float64)
+
+
+def _write_transform_files(texts, filenames):
+    """ Write the given transform parameter texts to the given files,
+    making each file refer to the previous as its initial transform.
+    Returns the last filename.
+    """
+    initial = 'NoInitialTransform'
+    for text, filename in zip(texts, filenames):
+        text = _set_parameter(text, 'InitialTransformParametersFileName',
+                              initial)
+        with open(filename, 'wb') as f:
+            f.write(text.encode('utf-8'))
+        initial = filename
+    return initial
+
+
+def _get_parameter(text, key):
+    """ Get the value of a parameter from the text of an Elastix parameter
+    file, as a list of values. Returns None if the parameter is not set.
+    """
+    match = re.search(r'^\(%s\s+(.*)\)[ \t]*$' % re.escape(key), text, re.M)
+    if match is None:
+        return None
+    return _parse_values(match.group(1))
+
+
+def _parse_values(text):
+    """ Parse the values of a parameter into a list of str/int/float.
+    """
+    values = []
+    for val in re.findall(r'"[^"]*"|[^\s"]+', text):
+        if val.startswith('"'):
+            values.append(val[1:-1])
+        else:
+            try:
+                values.append(int(val))
+            except ValueError:
+                values.append(float(val))
+    return values
+
+
+def _set_parameter(text, key, val):
+    """ Set a parameter in the text of an Elastix parameter file.
+    Returns the new text.
+    """
+    line = _param_to_line(key, val)
+    pattern = r'^\(%s\s+.*\)[ \t]*$' % re.escape(key)
+    if re.search(pattern, text, re.M):
+        return re.sub(pattern, lambda m: line, text, count=1, flags=re.M)
+    else:
+        return text.rstrip('\n') + '\n' + line + '\n'
+
+
+# %% Evaluating transforms with numpy
+
+# The transforms that can be evaluated without Transformix
+NUMPY_TRANSFORMS = ['TranslationTransform', 'EulerTransform',
+                    'AffineTransform', 'BSplineTransform']
+
+
+def _parse_parameters(text):
+    """ Parse the text of an Elastix parameter file into a dictionary
+    that maps parameter names to lists of values.
+    """
+    params = {}
+    for match in re.finditer(r'^\((\w+)\s+(.*)\)[ \t]*$', text, re.M):
+        params[match.group(1)] = _parse_values(match.group(2))
+    return params
+
+
+def _can_evaluate(texts):
+    """ Get whether the transform given by the parameter texts can be
+    evaluated with numpy.
+    """
+    for text in texts:
+        p = _parse_parameters(text)
+        if p.get('Transform', [''])[0] not in NUMPY_TRANSFORMS:
+            return False
+        if p.get('HowToCombineTransforms', ['Compose'])[0] not in (
+                'Compose', 'Add'):
+            return False
+        if p.get('UseCyclicTransform', ['false'])[0] == 'true':
+            return False
+    return True
+
+
+def _evaluate_points(texts, points):
+    """ Apply the transform given by the parameter texts (a chain, the
+    first being the initial transform) to the given points, an (N, ndim)
+    array with world coordinates in x-y-z order. Returns a new array.
+    """
+    points = np.asarray(points, np.float64)
+    result = points
+    for text in texts:
+        p = _parse_parameters(text)
+        if p.get('HowToCombineTransforms', ['Compose'])[0] == 'Add':
+            result = result + _evaluate_single(p, points) - points
+        else:
+            result = _evaluate_single(p, result)
+    return result
+
+
+def _evaluate_single(p, x):
+    """ Apply a single transform, given as parsed parameters, to points.
+    """
+    name = p['Transform'][0]
+    params = np.array(p['TransformParameters'], np.float64)
+    ndim = x.shape[1]
+    
+    if name == 'TranslationTransform':
+        return x + params
+    
+    elif name in ('EulerTransform', 'AffineTransform'):
+        center = np.array(p.get('CenterOfRotationPoint', [0] * ndim),
+                          np.float64)
+        if name == 'EulerTransform':
+            zyx = p.get('ComputeZYX', ['false'])[0] == 'true'
+            matrix = _euler_matrix(params[:-ndim], zyx)
+        else:
+            matrix = params[:ndim * ndim].reshape(ndim, ndim)
+        translation = params[-ndim:]
+        return np.dot(x - center, matrix.T) + center + translation
+    
+    elif name == 'BSplineTransform':
+        return x + _bspline_displacement(p, params, x)
+    
+    else:
+        raise ValueError('Cannot evaluate %s with numpy.' % name)
+
+
+def _euler_matrix(angles, zyx=False):
+    """ Get the rotation matrix for the given angles, like ITK does for
+    the Euler transform.
+    """
+    if len(angles) == 1:
+        c, s = np.cos(angles[0]), np.sin(angles[0])
+        return np.array([[c, -s], [s, c]])
+    cx, cy, cz = np.cos(angles)
+    sx, sy, sz = np.sin(angles)
+    rx = np.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]])
+    ry = np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+    rz = np.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]])
+    if zyx:
+        return np.dot(rz, np.dot(ry, rx))
+    else:
+        return np.dot(rz, np.dot(rx, ry))
+
+
+def _bspline_kernel(t, order):
+    """ Evaluate the B-spline kernel of the given order (1, 2 or 3).
+    """
+    t = np.abs(t)
+    if order == 1:
+        return np.where(t < 1, 1 - t, 0.0)
+    elif order == 2:
+        return np.where(t < 0.5, 0.75 - t ** 2,
+                        np.where(t < 1.5, 0.5 * (1.5 - t) ** 2, 0.0))
+    elif order == 3:
+        return np.where(t < 1, (4 - 6 * t ** 2 + 3 * t ** 3) / 6,
+                        np.where(t < 2, (2 - t) ** 3 / 6, 0.0))
+    else:
+        raise ValueError('Unsupported B-spline order %i.' % order)
+
+
+def _bspline_displacement(p, params, x):
+    """ Get the displacement of a B-spline transform at the given points.
+    Points outside of the valid region of the grid are not displaced.
+    """
+    ndim = x.shape[1]
+    order = int(p.get('BSplineTransformSplineOrder', [3])[0])
+    size = np.array(p['GridSize'], int)
+    index = np.array(p.get('GridIndex', [0] * ndim), np.float64)
+    spacing = np.array(p['GridSpacing'], np.float64)
+    origin = np.array(p['GridOrigin'], np.float64)
+    direction = np.array(p.get('GridDirection', np.eye(ndim).ravel()),
+                         np.float64).reshape(ndim, ndim).T
+    coefs = params.reshape(ndim, -1)
+    
+    # Get continuous index in the grid of coefficients
+    cindex = np.dot(x - origin, np.linalg.inv(direction).T) / spacing
+    cindex -= index
+    
+    # Get the first grid point that supports each point
+    offset = 0.5 * (order - 1)
+    inside = np.all((cindex >= offset) & (cindex <= size - 1 - offset), 1)
+    start = np.floor(cindex - offset).astype(int)
+    
+    # Get the weights for each dimension
+    weights = [[_bspline_kernel(cindex[:, d] - (start[:, d] + k), order)
+                for k in range(order + 1)] for d in range(ndim)]
+    
+    # Sum the contributions of the supporting grid points
+    displacement = np.zeros_like(x)
+    for ks in itertools.product(range(order + 1), repeat=ndim):
+        w = weights[0][ks[0]]
+        for d in range(1, ndim):
+            w = w * weights[d][ks[d]]
+        idx = [np.clip(start[:, d] + ks[d], 0, size[d] - 1)
+               for d in range(ndim)]
+        flat = np.ravel_multi_index(tuple(reversed(idx)), tuple(size[::-1]))
+        for d in range(ndim):
+            displacement[:, d] += w * coefs[d][flat]
+    displacement[~inside] = 0
+    return displacement
+
+
+def _evaluate_field(texts, region=None, out=None):
+    """ Get the deformation field of the transform given by the parameter
+    texts, on the grid of the fixed image (or the given region of it: a
+    tuple of slices in z-y-x order). Returns an Image with the field
+    stacked in the last dimension, like Transformix produces.
+    """
+    p = _parse_parameters(texts[-1])
+    ndim = len(p['Size'])
+    size = np.array(p['Size'], int)
+    index = np.array(p.get('Index', [0] * ndim), np.float64)
+    spacing = np.array(p['Spacing'], np.float64)
+    origin = np.array(p['Origin'], np.float64)
+    direction = np.eye(ndim)
+    if p.get('UseDirectionCosines', ['true'])[0] == 'true':
+        if 'Direction' in p:
+            direction = np.array(p['Direction'], np.float64)
+            direction = direction.reshape(ndim, ndim).T
+    
+    # Get the indices to sample, in z-y-x order
+    shape = tuple(size[::-1])
+    region = tuple(region or ()) + (slice(None), ) * (ndim - len(region or ()))
+    ranges = [np.arange(n)[r] for n, r in zip(shape, region)]
+    field_shape = tuple(len(r) for r in ranges) + (ndim, )
+    
+    # Prepare output
+    if out is None:
+        field = np.empty(field_shape, np.float32)
+    elif out.size != np.prod(field_shape) or not out.flags.c_contiguous:
+        raise ValueError('Output array must be C-contiguous and have '
+                         '%i elements.' % np.prod(field_shape))
+    else:
+        field = out.reshape(field_shape)
+    
+    # Evaluate in chunks (along the first dimension) to limit memory use
+    n_per_slice = max(1, int(np.prod(field_shape[1:-1])))
+    chunk = max(1, 2 ** 16 // n_per_slice)
+    for i0 in range(0, field_shape[0], chunk):
+        grid = np.meshgrid(ranges[0][i0:i0 + chunk], *ranges[1:],
+                           indexing='ij')
+        idx = np.stack([g.ravel() for g in reversed(grid)], 1)
+        points = origin + np.dot((idx + index) * spacing, direction.T)
+        values = _evaluate_points(texts, points) - points
+        field[i0:i0 + chunk] = values.reshape(grid[0].shape + (ndim, ))
+    
+    # Determine sampling and origin, in z-y-x order
+    field = Image(field)
+    steps = [r.step or 1 for r in region]
+    starts = [(rng[0] if len(rng) else 0) for rng in ranges]
+    first = origin + np.dot((np.array(starts[::-1]) + index) * spacing,
+                            direction.T)
+    field.sampling = [float(s * step)
+                      for s, step in zip(spacing[::-1], steps)] + [1.0]
+    field.origin = [float(o) for o in first[::-1]] + [0]
+    return field
 
 
 # %% Code related to parameters
@@ -972,6 +3542,188 @@ def get_default_params(type='BSPLINE'):
     return p
 
 
+# Sizes of the images used to calibrate the cost model, per dimension
+_CALIBRATION_SHAPES = {2: [(128, 128), (256, 256)],
+                       3: [(32, 32, 32), (48, 48, 48)]}
+
+
+def _get_cost_model_file():
+    return os.path.join(_get_user_cache_dir(), 'costs.json')
+
+
+def _get_transform_kind(type):
+    """ Normalize the type of transform, as given to get_default_params().
+    """
+    type = type.upper()
+    if type in ['B', 'BSPLINE', 'B-SPLINE']:
+        return 'BSPLINE'
+    elif type in ['RIGID', 'EULER']:
+        return 'RIGID'
+    elif type == 'AFFINE':
+        return 'AFFINE'
+    raise ValueError('Invalid transform type %r.' % type)
+
+
+def calibrate_cost_model(type='BSPLINE', ndim=2, verbose=0):
+    """ calibrate_cost_model(type='BSPLINE', ndim=2, verbose=0)
+    
+    Measure how long registrations take on this machine, as used by
+    `get_params_for_budget()`. Performs four short registrations of
+    random images of the given dimensionality, with the given type of
+    transform. The result is stored on disk (for the current Elastix
+    executable), so this only needs to be called again when e.g. the
+    hardware changes. Returns a dict with the cost model:
+    
+    * start: the fixed cost of a registration (in seconds).
+    * voxel: the cost per voxel per resolution (in seconds).
+    * iteration: the fixed cost of an iteration (in seconds).
+    * sample: the cost of an iteration per spatial sample (in seconds).
+    """
+    kind = _get_transform_kind(type)
+    if ndim not in _CALIBRATION_SHAPES:
+        raise ValueError('Can only calibrate for 2D and 3D images.')
+    small, large = _CALIBRATION_SHAPES[ndim]
+    s1, s2 = 512, 4096
+    n1, n2 = 20, 100
+    
+    def run(shape, samples, iterations):
+        # Random images, so that the result cache is never used
+        im1 = np.random.uniform(0, 100, shape).astype(np.float32)
+        im2 = np.random.uniform(0, 100, shape).astype(np.float32)
+        params = get_default_params(kind)
+        params.NumberOfResolutions = 1
+        params.NumberOfSpatialSamples = samples
+        params.MaximumNumberOfIterations = iterations
+        report = RegistrationReport()
+        register(im1, im2, params, verbose=0, report=report)
+        if verbose:
+            print('calibration %s, %i samples, %i iterations: %.3f s' % (
+                  'x'.join(map(str, shape)), samples, iterations,
+                  report.total))
+        return report.total
+    
+    # Four runs to solve the four unknowns of the model
+    t1 = run(small, s1, n1)
+    t2 = run(small, s2, n1)
+    t3 = run(small, s1, n2)
+    t4 = run(large, s1, n1)
+    v1, v4 = float(np.prod(small)), float(np.prod(large))
+    t_iter = max(t3 - t1, 0.0) / (n2 - n1)
+    model = {}
+    model['sample'] = max(t2 - t1, 0.0) / (n1 * (s2 - s1))
+    model['iteration'] = max(t_iter - model['sample'] * s1, 1e-6)
+    model['voxel'] = max(t4 - t1, 0.0) / (v4 - v1)
+    model['start'] = max(t1 - model['voxel'] * v1 - n1 * t_iter, 0.0)
+    
+    _save_cost_model('%s-%iD' % (kind, ndim), model)
+    return model
+
+
+def _load_cost_model(key):
+    """ Get the stored cost model for the current Elastix executable,
+    or None.
+    """
+    exe = get_elastix_exes()[0]
+    filename = _get_cost_model_file()
+    try:
+        if not _is_own_file(filename):
+            return None
+        with open(filename, 'rb') as f:
+            mtime, models = json.loads(f.read().decode())[exe]
+        if os.path.getmtime(_get_exe_path(exe)) != mtime:
+            return None
+        return models[key]
+    except Exception:
+        return None
+
+
+def _save_cost_model(key, model):
+    """ Store a cost model on disk, for the current Elastix executable.
+    """
+    exe = get_elastix_exes()[0]
+    filename = _get_cost_model_file()
+    try:
+        try:
+            with open(filename, 'rb') as f:
+                data = json.loads(f.read().decode())
+        except Exception:
+            data = {}
+        mtime = os.path.getmtime(_get_exe_path(exe))
+        if data.get(exe, [None])[0] != mtime:
+            data[exe] = [mtime, {}]
+        data[exe][1][key] = model
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename), 0o700)
+        tmp = '%s.%i' % (filename, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(json.dumps(data).encode())
+        os.replace(tmp, filename)
+    except Exception:
+        pass  # Not being able to store is not a problem
+
+
+def get_params_for_budget(image, type='BSPLINE', seconds=60.0):
+    """ get_params_for_budget(image, type='BSPLINE', seconds=60.0)
+    
+    Get `Parameters` struct like `get_default_params()`, but with the
+    number of resolutions, spatial samples and iterations (and the
+    grid spacing of a B-spline transform) chosen based on the size of
+    the given image (an array or a shape tuple), such that a
+    registration takes about the given number of seconds on this
+    machine (including writing and reading the data).
+    
+    The time is predicted with a cost model that is measured with
+    `calibrate_cost_model()`, which is called automatically (and stored
+    on disk) the first time a type of transform and dimensionality is
+    used. Raises ValueError if the budget is too small for even a
+    minimal registration.
+    """
+    kind = _get_transform_kind(type)
+    shape = tuple(image) if isinstance(image, tuple) else image.shape
+    ndim = len(shape)
+    nvoxels = float(np.prod(shape))
+    sampling = getattr(image, 'sampling', [1.0] * ndim)
+    
+    # Get the cost model
+    key = '%s-%iD' % (kind, ndim)
+    model = _load_cost_model(key)
+    if model is None:
+        model = calibrate_cost_model(kind, ndim)
+    
+    def iteration_time(samples):
+        return model['iteration'] + model['sample'] * samples
+    
+    # Pyramid depth: the coarsest level should be at least 16 voxels wide
+    n_res = int(np.log2(max(min(shape), 16) / 16.0)) + 1
+    n_res = min(n_res, 6)
+    
+    # Time left for the iterations, per resolution
+    overhead = model['start'] + model['voxel'] * nvoxels * n_res
+    budget = (seconds - overhead) / n_res
+    
+    # More samples for larger images, but fewer if this leaves too
+    # few iterations to converge
+    samples = int(np.clip(8 * nvoxels ** 0.5, 2048, 16384))
+    if budget < 200 * iteration_time(samples) and model['sample'] > 0:
+        wanted = (budget / 200 - model['iteration']) / model['sample']
+        samples = int(np.clip(wanted, 512, samples))
+    iterations = int(min(budget / iteration_time(samples), 2000))
+    if iterations < 16:
+        minimum = overhead + n_res * 16 * iteration_time(samples)
+        raise ValueError('A registration of an image of shape %s takes at '
+                         'least %.1f seconds.' % (shape, minimum))
+    
+    p = get_default_params(kind)
+    p.NumberOfResolutions = n_res
+    p.NumberOfSpatialSamples = samples
+    p.MaximumNumberOfIterations = iterations
+    if kind == 'BSPLINE':
+        # Not too many control points for large images
+        spacing = max(16, min(shape) // 32)
+        p.FinalGridSpacingInPhysicalUnits = spacing * min(sampling)
+    return p
+
+
 def _compile_params(params, im1):
     """ Compile the params dictionary:
     * Combine parameters from different sources
@@ -1002,47 +3754,399 @@ def _compile_params(params, im1):
     return params
 
 
-def _write_parameter_file(params):
+def _write_parameter_file(params, workspace=None, fname='params.txt'):
     """ Write the parameter file in the format that elaxtix likes.
     """
     
     # Get path
-    path = os.path.join(get_tempdir(), 'params.txt')
+    path = os.path.join(workspace or get_tempdir(), fname)
+    
+    # Compile text
+    text = _params_to_text(params)
+    
+    # Write text
+    f = open(path, 'wb')
+    try:
+        f.write(text.encode('utf-8'))
+    finally:
+        f.close()
+    
+    # Done
+    return path
+
+
+def _params_to_text(params):
+    """ Get the text of a parameter file for the given parameters.
+    """
+    text = ''
+    for key in params:
+        text += _param_to_line(key, params[key]) + '\n'
+    return text
+
+
+def _param_to_line(key, val):
+    """ Get the line for a parameter in the format that elastix likes.
+    """
     
     # Define helper function
     def valToStr(val):
-        if val in [True, False]:
-            return '"%s"' % str(val).lower()
-        elif isinstance(val, int):
+        if isinstance(val, (bool, np.bool_)):
+            return '"%s"' % str(bool(val)).lower()
+        elif isinstance(val, (int, np.integer)):
             return str(val)
-        elif isinstance(val, float):
-            tmp = str(val)
+        elif isinstance(val, (float, np.floating)):
+            tmp = str(float(val))
             if '.' not in tmp:
                 tmp += '.0'
             return tmp
         elif isinstance(val, str):
             return '"%s"' % val
     
-    # Compile text
-    text = ''
-    for key in params:
-        val = params[key]
-        # Make a string of the values
-        if isinstance(val, (list, tuple)):
-            vals = [valToStr(v) for v in val]
-            val_ = ' '.join(vals)
-        else:
-            val_ = valToStr(val)
-        # Create line and add
-        line = '(%s %s)' % (key, val_)
-        text += line + '\n'
+    # Make a string of the values
+    if isinstance(val, (list, tuple)):
+        vals = [valToStr(v) for v in val]
+        val_ = ' '.join(vals)
+    else:
+        val_ = valToStr(val)
+    return '(%s %s)' % (key, val_)
+
+
+# %% Command line interface
+
+
+_JOB_STATES = ('pending', 'running', 'done', 'failed')
+
+
+class _JobStore:
+    """ SQLite database that records the state of the jobs of a batch,
+    so that a batch can be resumed. Only used from the main thread.
+    """
     
-    # Write text
-    f = open(path, 'wb')
+    def __init__(self, filename):
+        import sqlite3
+        self._db = sqlite3.connect(filename, timeout=60)
+        self._db.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                         "id TEXT PRIMARY KEY, moving TEXT, fixed TEXT, "
+                         "state TEXT, attempts INTEGER DEFAULT 0, "
+                         "next_try REAL DEFAULT 0, pid INTEGER, "
+                         "started REAL, finished REAL, duration REAL, "
+                         "times TEXT, output TEXT, error TEXT)")
+        self._db.commit()
+    
+    def close(self):
+        self._db.close()
+    
+    def add(self, jobs):
+        """ Add (id, moving, fixed) jobs. Existing jobs are kept as is.
+        """
+        with self._db:
+            self._db.executemany("INSERT OR IGNORE INTO jobs "
+                                 "(id, moving, fixed, state) "
+                                 "VALUES (?, ?, ?, 'pending')", jobs)
+    
+    def recover(self, retry_failed=False):
+        """ Reset running jobs of processes that no longer exist (e.g.
+        because the node died) to pending, and optionally also the
+        failed jobs.
+        """
+        rows = self._db.execute("SELECT id, pid FROM jobs "
+                                "WHERE state = 'running'").fetchall()
+        with self._db:
+            for id, pid in rows:
+                if pid is None or not _is_pid_running(pid):
+                    self._db.execute("UPDATE jobs SET state = 'pending' "
+                                     "WHERE id = ?", (id, ))
+            if retry_failed:
+                self._db.execute("UPDATE jobs SET state = 'pending', "
+                                 "attempts = 0, next_try = 0 "
+                                 "WHERE state = 'failed'")
+    
+    def claim(self, now):
+        """ Mark the next pending job that is due as running, and return
+        `(id, moving, fixed)`, or None.
+        """
+        while True:
+            row = self._db.execute("SELECT id, moving, fixed FROM jobs "
+                                   "WHERE state = 'pending' AND "
+                                   "next_try <= ? ORDER BY next_try, rowid "
+                                   "LIMIT 1", (now, )).fetchone()
+            if row is None:
+                return None
+            # Another process may have claimed it in the mean time
+            with self._db:
+                cursor = self._db.execute(
+                    "UPDATE jobs SET state = 'running', pid = ?, "
+                    "started = ?, attempts = attempts + 1 "
+                    "WHERE id = ? AND state = 'pending'",
+                    (os.getpid(), now, row[0]))
+            if cursor.rowcount:
+                return row
+    
+    def next_try(self):
+        """ Get the time at which the next pending job is due, or None.
+        """
+        return self._db.execute("SELECT MIN(next_try) FROM jobs "
+                                "WHERE state = 'pending'").fetchone()[0]
+    
+    def finish(self, id, report, output):
+        with self._db:
+            self._db.execute("UPDATE jobs SET state = 'done', "
+                             "finished = ?, duration = ?, times = ?, "
+                             "output = ?, error = NULL WHERE id = ?",
+                             (time.time(), report.total,
+                              json.dumps(report.times), output, id))
+    
+    def fail(self, id, report, error, retries, backoff):
+        """ Mark a job as failed, or as pending again (with exponential
+        backoff) if it has been tried at most `retries` times.
+        """
+        attempts, = self._db.execute("SELECT attempts FROM jobs "
+                                     "WHERE id = ?", (id, )).fetchone()
+        state, next_try = 'failed', 0
+        if attempts <= retries:
+            state = 'pending'
+            next_try = time.time() + backoff * 2 ** (attempts - 1)
+        with self._db:
+            self._db.execute("UPDATE jobs SET state = ?, next_try = ?, "
+                             "finished = ?, duration = ?, times = ?, "
+                             "error = ? WHERE id = ?",
+                             (state, next_try, time.time(), report.total,
+                              json.dumps(report.times), error, id))
+        return state
+    
+    def counts(self):
+        """ Get a dict with the number of jobs in each state.
+        """
+        counts = dict.fromkeys(_JOB_STATES, 0)
+        counts.update(self._db.execute("SELECT state, COUNT(*) FROM jobs "
+                                       "GROUP BY state").fetchall())
+        return counts
+    
+    def failures(self):
+        return self._db.execute("SELECT id, attempts, error FROM jobs "
+                                "WHERE state = 'failed' "
+                                "ORDER BY rowid").fetchall()
+
+
+def _read_manifest(filename):
+    """ Read the (id, moving, fixed) jobs from a CSV file with a header
+    row. The "moving" and "fixed" columns are required. Relative paths
+    are relative to the manifest. Without an "id" column, the row
+    number is used.
+    """
+    import csv
+    root = os.path.dirname(os.path.abspath(filename))
+    jobs = []
+    with open(filename, newline='') as f:
+        reader = csv.DictReader(f)
+        if not {'moving', 'fixed'}.issubset(reader.fieldnames or []):
+            raise ValueError('The manifest must have a "moving" and a '
+                             '"fixed" column.')
+        for i, row in enumerate(reader):
+            id = (row.get('id') or '').strip() or str(i + 1)
+            # The id is used as the name of the output directory
+            if (id in ('.', '..') or os.path.isabs(id) or
+                    any(sep and sep in id for sep in ('/', os.sep,
+                                                      os.altsep))):
+                raise ValueError('Invalid id %r in the manifest: ids are '
+                                 'used as directory names.' % id)
+            paths = [os.path.join(root, row[key].strip())
+                     for key in ('moving', 'fixed')]
+            jobs.append((id, paths[0], paths[1]))
+    if len(set(job[0] for job in jobs)) != len(jobs):
+        raise ValueError('The ids in the manifest must be unique.')
+    return jobs
+
+
+def _parse_cli_param(s):
+    """ Parse a "key=value" parameter given on the command line. A value
+    can be a number, true/false, or a string, or a list of these,
+    separated by spaces.
+    """
+    if '=' not in s:
+        raise ValueError('Parameters must be given as key=value.')
+    key, value = s.split('=', 1)
+    values = []
+    for v in value.split():
+        if v.lower() in ('true', 'false'):
+            values.append(v.lower() == 'true')
+            continue
+        for type in (int, float, str):
+            try:
+                values.append(type(v))
+                break
+            except ValueError:
+                pass
+    return key.strip(), values[0] if len(values) == 1 else values
+
+
+def _run_job(moving, fixed, params, outdir, root):
+    """ Perform the registration of a job, writing all output to outdir,
+    which must be a subdirectory of root. Returns `(report, error)`.
+    """
+    report = RegistrationReport()
     try:
-        f.write(text.encode('utf-8'))
+        parent = os.path.dirname(os.path.realpath(outdir))
+        if parent != os.path.realpath(root):
+            raise ValueError('Output directory %r is not in %r.' %
+                             (outdir, root))
+        if os.path.isdir(outdir):
+            shutil.rmtree(outdir)  # Output of a failed attempt
+        # Memory map the results, since only the files are needed
+        register(moving, fixed, params, verbose=0, output_dir=outdir,
+                 mmap=True, report=report)
+    except Exception as err:
+        return report, '%s: %s' % (type(err).__name__, err)
+    return report, None
+
+
+def _batch(args):
+    """ Run (or resume) a batch of registrations.
+    """
+    params = get_default_params(args.type)
+    for s in args.param:
+        key, value = _parse_cli_param(s)
+        setattr(params, key, value)
+    
+    if not os.path.isdir(args.out):
+        os.makedirs(args.out)
+    store = _JobStore(args.db or os.path.join(args.out, 'jobs.sqlite'))
+    store.add(_read_manifest(args.manifest))
+    store.recover(args.retry_failed)
+    
+    # Divide the cores between the jobs, unless a budget is given
+    budget = get_thread_budget()
+    if budget[0] is None:
+        total = os.cpu_count() or 1
+        set_thread_budget(total, max(1, total // args.jobs))
+    try:
+        _run_batch(store, params, args)
     finally:
-        f.close()
+        set_thread_budget(*budget)
     
-    # Done
-    return path
+    counts = store.counts()
+    store.close()
+    print(', '.join('%i %s' % (counts[s], s) for s in _JOB_STATES))
+    return 1 if counts['failed'] else 0
+
+
+def _run_batch(store, params, args):
+    """ Run the jobs in the store until none are pending or due for a
+    retry.
+    """
+    # The jobs mostly wait for Elastix, so threads suffice
+    running = {}
+    with _futures.ThreadPoolExecutor(args.jobs) as executor:
+        while True:
+            while len(running) < args.jobs:
+                job = store.claim(time.time())
+                if job is None:
+                    break
+                id, moving, fixed = job
+                root = os.path.abspath(args.out)
+                outdir = os.path.join(root, id)
+                future = executor.submit(_run_job, moving, fixed, params,
+                                         outdir, root)
+                running[future] = id, outdir
+            # Wait for a job to finish, or for a retry to become due
+            next_try = store.next_try()
+            if not running and next_try is None:
+                break
+            timeout = None
+            if next_try is not None:
+                timeout = max(next_try - time.time(), 0.01)
+            if not running:
+                time.sleep(timeout)  # wait() would return at once
+                continue
+            done, _ = _futures.wait(running, timeout,
+                                    return_when=_futures.FIRST_COMPLETED)
+            for future in done:
+                id, outdir = running.pop(future)
+                report, error = future.result()
+                if error is None:
+                    store.finish(id, report, outdir)
+                    print('done    %s (%.1f s)' % (id, report.total))
+                else:
+                    state = store.fail(id, report, error, args.retries,
+                                       args.backoff)
+                    state = 'failed' if state == 'failed' else 'retry'
+                    print('%-7s %s: %s' % (state, id, error))
+                sys.stdout.flush()
+
+
+def _status(args):
+    """ Show the state of the jobs of a batch.
+    """
+    if not os.path.isfile(args.db):
+        raise ValueError('No job store at %s.' % args.db)
+    store = _JobStore(args.db)
+    counts = store.counts()
+    print(', '.join('%i %s' % (counts[s], s) for s in _JOB_STATES))
+    for id, attempts, error in store.failures():
+        print('failed  %s (%i attempts): %s' % (id, attempts, error))
+    store.close()
+    return 1 if counts['failed'] else 0
+
+
+def main(argv=None):
+    """ main(argv=None)
+    
+    Entry point of the `pyelastix` command (also available as `python -m
+    pyelastix`). The `batch` command registers the image pairs listed in
+    a CSV manifest (with a "moving" and "fixed" column, and optionally
+    an "id" column) and writes the output of each job (result image,
+    deformation field, transform parameters and log) to a subdirectory
+    of the output directory as soon as it finishes:
+    
+        pyelastix batch manifest.csv --jobs 8 --out results/
+    
+    The state of each job (pending, running, done or failed), its timings
+    and output directory are recorded in a SQLite database (by default
+    jobs.sqlite in the output directory). When the command is run again,
+    completed jobs are skipped, and jobs that were running in a process
+    that no longer exists are restarted. Failed jobs are retried with
+    exponential backoff. The `status` command shows the state of the
+    jobs. Returns the exit code: 1 if any job failed.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog='pyelastix', description='Image registration with Elastix.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    
+    p = commands.add_parser('batch', help='register the pairs in a '
+                            'manifest, resuming where a previous run ended')
+    p.add_argument('manifest', help='CSV file with columns moving, fixed '
+                   'and (optionally) id')
+    p.add_argument('--out', default='.', help='output directory')
+    p.add_argument('--db', help='job store (default OUT/jobs.sqlite)')
+    p.add_argument('--jobs', type=int, default=1,
+                   help='number of registrations to run at the same time')
+    p.add_argument('--type', default='BSPLINE',
+                   help='type of transform: RIGID, AFFINE or BSPLINE')
+    p.add_argument('--param', action='append', default=[],
+                   metavar='KEY=VALUE', help='set an Elastix parameter')
+    p.add_argument('--retries', type=int, default=2,
+                   help='number of times to retry a failing job')
+    p.add_argument('--backoff', type=float, default=10.0,
+                   help='seconds to wait before the first retry (doubled '
+                   'for each next retry)')
+    p.add_argument('--retry-failed', action='store_true',
+                   help='also retry jobs that failed in a previous run')
+    p.set_defaults(func=_batch)
+    
+    p = commands.add_parser('status', help='show the state of the jobs')
+    p.add_argument('db', help='job store, e.g. results/jobs.sqlite')
+    p.set_defaults(func=_status)
+    
+    args = parser.parse_args(argv)
+    if getattr(args, 'jobs', 1) < 1:
+        parser.error('--jobs must be at least 1')
+    try:
+        return args.func(args)
+    except (ValueError, IOError) as err:
+        parser.exit(2, 'pyelastix: error: %s\n' % err)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -19,7 +19,7 @@ Register and upload package
 """
 
 import os
-from distutils.core import setup
+from setuptools import setup
 
 name = 'pyelastix'
 description = 'Python wrapper for the Elastix nonrigid registration toolkit'
@@ -59,6 +59,8 @@ setup(
     provides = ['pyelastix'],
 
     py_modules = ['pyelastix'],
+    install_requires = ['numpy'],
+    entry_points = {'console_scripts': ['pyelastix = pyelastix:main']},
 
     classifiers=[
           'Development Status :: 4 - Beta',
@@ -1,3 +1,15 @@
+import os
+import gc
+import sys
+import time
+import zlib
+import pickle
+import shutil
+import asyncio
+import threading
+import subprocess
+
+import numpy as np
 import pytest
 import imageio
 from skimage import transform, color
@@ -41,3 +53,924 @@ def test_register_affine_gray():
 
     # Check the results
     assert image_registered == pytest.approx(image_fixed, rel=1)
+
+
+def use_stub(monkeypatch):
+    """ Use the stub elastix and transformix of the benchmarks.
+    """
+    if sys.platform.startswith('win'):
+        pytest.skip('The stub executables need a Unix shell')
+    stub = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                        'benchmarks', 'stub')
+    monkeypatch.setattr(pyelastix, 'EXES', [os.path.join(stub, 'elastix'),
+                                            os.path.join(stub, 'transformix')])
+
+
+def test_image_pickle():
+    # Sampling and origin must survive being sent to/from worker processes
+    im = pyelastix.Image(np.zeros((3, 4), 'float32'))
+    im.sampling = (2.0, 3.0)
+    im.origin = (1.0, 0.0)
+    im2 = pickle.loads(pickle.dumps(im))
+    assert isinstance(im2, pyelastix.Image)
+    assert im2.shape == (3, 4)
+    assert im2.sampling == (2.0, 3.0)
+    assert im2.origin == (1.0, 0.0)
+
+
+def test_register_many(monkeypatch):
+    use_stub(monkeypatch)
+    params = pyelastix.get_default_params('AFFINE')
+    params.MaximumNumberOfIterations = 10
+    ims = [np.full((10 + i, 12), i, 'float32') for i in range(5)]
+    pairs = [(im, im) for im in ims]
+    pairs[2] = '/does/not/exist.mhd', ims[2]
+
+    results = list(pyelastix.register_many(iter(pairs), params, 2))
+    assert sorted(r[0] for r in results) == [0, 1, 2, 3, 4]
+    for index, result, error in results:
+        if index == 2:
+            assert result is None and isinstance(error, ValueError)
+        else:
+            a, field = result
+            assert error is None
+            assert a.shape == ims[index].shape and (a == index).all()
+            assert len(field) == 2 and field[0].shape == a.shape
+
+
+def test_register_async(monkeypatch):
+    use_stub(monkeypatch)
+    params = pyelastix.get_default_params('AFFINE')
+    params.MaximumNumberOfIterations = 10
+    im1 = np.full((10, 12), 3, 'float32')
+    im2 = np.zeros((10, 12), 'float32')
+    budget = pyelastix.get_thread_budget()
+    loop = asyncio.new_event_loop()
+    try:
+        a, field = loop.run_until_complete(
+            pyelastix.register_async(im1, im2, params))
+        assert a.shape == im1.shape and (a == 3).all()
+        assert len(field) == 2 and field[0].shape == im1.shape
+
+        # Waiting for the thread budget does not block the loop
+        commands = []
+        create = asyncio.create_subprocess_exec
+
+        async def create_subprocess_exec(*args, **kwargs):
+            commands.append((args, await create(*args, **kwargs)))
+            return commands[-1][1]
+
+        monkeypatch.setattr(asyncio, 'create_subprocess_exec',
+                            create_subprocess_exec)
+        pyelastix.set_thread_budget(2)
+        n = pyelastix._thread_budget.acquire()
+        task = loop.create_task(pyelastix.register_async(im1, im2, params))
+        loop.run_until_complete(asyncio.sleep(0.2))
+        assert not commands and not task.done()
+        pyelastix._thread_budget.release(n)
+        loop.run_until_complete(task)
+        assert commands[0][0][-2:] == ('-threads', '2')
+
+        # Cancelling kills the elastix process, and releases the threads
+        del commands[:]
+        monkeypatch.setenv('STUB_ITERATION_TIME', '0.1')
+        task = loop.create_task(pyelastix.register_async(im1, im2, params))
+        while not commands:
+            loop.run_until_complete(asyncio.sleep(0.01))
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            loop.run_until_complete(task)
+        assert commands[0][1].returncode is not None
+        assert pyelastix._thread_budget.acquire(False) == 2
+        pyelastix._thread_budget.release(2)
+
+        # Errors of elastix are raised
+        monkeypatch.setattr(pyelastix, 'EXES', [shutil.which('false')] * 2)
+        with pytest.raises(RuntimeError):
+            loop.run_until_complete(pyelastix.register_async(im1, im2,
+                                                             params))
+        with pytest.raises(RuntimeError):
+            loop.run_until_complete(pyelastix.transformix_async('foo.txt'))
+    finally:
+        pyelastix.set_thread_budget(*budget)
+        loop.close()
+
+
+def test_output_parser():
+    lines = ['Resolution: 1\n',
+             '1:ItNr\t2:Metric\t3a:Time\t3b:StepSize\t4:||Gradient||\tTime[ms]\n',
+             '12\t-0.512\t12.0\t0.75\t0.031\t4.0\n',
+             'Time spent in resolution 1 (ITK initialisation and '
+             'iterating): 2.5 s.\n',
+             'Some other output\n']
+    parser = pyelastix._OutputParser()
+    events = [parser.feed(line) for line in lines]
+
+    assert events[0].kind == 'resolution'
+    assert events[0].resolution == 1
+    assert events[1] is None
+    assert events[2].kind == 'iteration'
+    assert events[2].resolution == 1
+    assert events[2].iteration == 12
+    assert events[2].metric == -0.512
+    assert events[2].step_size == 0.75
+    assert events[2].gradient == 0.031
+    assert events[2].time == pytest.approx(0.004)
+    assert events[3].kind == 'resolution_done'
+    assert events[3].time == 2.5
+    assert events[4] is None
+
+
+def test_write_memmap_without_copy(tmp_path):
+    # A memmap (view) is referred to, instead of copied
+    fname = str(tmp_path / 'data.raw')
+    m = np.memmap(fname, 'float32', 'w+', shape=(10, 20, 30))
+    m[:] = np.arange(m.size).reshape(m.shape)
+    m.flush()
+    assert pyelastix._get_file_location(m) == (fname, 0)
+    assert pyelastix._get_file_location(m[2]) == (fname, 2 * 600 * 4)
+    assert pyelastix._get_file_location(m[:, 2]) is None
+    assert pyelastix._get_file_location(np.zeros((3, 4))) is None
+
+    path = pyelastix._write_image_data(m[2], 1, str(tmp_path))
+    text = open(path).read()
+    assert 'HeaderSize = 4800\n' in text
+    assert text.endswith('ElementDataFile = %s\n' % fname)
+    assert not (tmp_path / 'im1.raw').exists()
+
+
+def test_read_image_data_modes(tmp_path):
+    im = np.arange(12, dtype='float32').reshape(3, 4)
+    pyelastix._write_image_data(im, 1, str(tmp_path))
+
+    # Default: a new writable array
+    a = pyelastix._read_image_data('im1.mhd', str(tmp_path))
+    assert a.flags.writeable
+    assert np.all(a == im)
+
+    # Memory mapped, copy-on-write
+    b = pyelastix._read_image_data('im1.mhd', str(tmp_path), mmap=True)
+    assert isinstance(b.base, np.memmap)
+    b[0, 0] = 42
+    assert np.all(pyelastix._read_image_data('im1.mhd', str(tmp_path)) == im)
+
+    # Read into a given array
+    out = np.empty(12, 'float32')
+    c = pyelastix._read_image_data('im1.mhd', str(tmp_path), out=out)
+    assert np.shares_memory(c, out)
+    assert c.shape == (3, 4)
+    assert np.all(c == im)
+    with pytest.raises(ValueError):
+        pyelastix._read_image_data('im1.mhd', str(tmp_path),
+                                   out=np.empty(12, 'float64'))
+
+
+def test_input_cache(tmp_path):
+    im1 = np.zeros((10, 10), 'float32')
+    im2 = np.ones((10, 10), 'float32')
+    assert pyelastix._hash_image(im1) != pyelastix._hash_image(im2)
+    im3 = pyelastix.Image(im1.copy())
+    im3.sampling = (2, 2)
+    assert pyelastix._hash_image(im1) != pyelastix._hash_image(im3)
+
+    # The same image is written once
+    pyelastix.set_input_cache(1500, str(tmp_path))
+    try:
+        path1 = pyelastix._write_cached_image_data(im1)
+        assert pyelastix._write_cached_image_data(im1.copy()) == path1
+        assert os.path.isfile(path1)
+        # Each entry is 400 bytes plus header, so only two entries fit
+        path2 = pyelastix._write_cached_image_data(im2)
+        path3 = pyelastix._write_cached_image_data(im3)
+        assert not os.path.isfile(path1)
+        assert os.path.isfile(path2) and os.path.isfile(path3)
+        # Images that exceed the limit are kept while they are being used
+        pyelastix.set_input_cache(100, str(tmp_path))
+        path1 = pyelastix._write_cached_image_data(im1)
+        assert os.path.isfile(path1)
+        assert not os.path.isfile(path2) and not os.path.isfile(path3)
+        assert pyelastix._write_cached_image_data(im1) == path1
+        path2 = pyelastix._write_cached_image_data(im2, [path1])
+        assert os.path.isfile(path1) and os.path.isfile(path2)
+        path3 = pyelastix._write_cached_image_data(im3)
+        assert os.path.isfile(path3) and not os.path.isfile(path1)
+    finally:
+        pyelastix.set_input_cache(0)
+
+
+def test_result_cache_key():
+    im1 = np.zeros((10, 10), 'float32')
+    im2 = np.ones((10, 10), 'float32')
+    _, params = pyelastix._get_registration_params(
+        im1, im2, pyelastix.get_default_params(), False)
+    key = pyelastix._get_result_key(im1, im2, params)
+    assert pyelastix._get_result_key(im1.copy(), im2.copy(),
+                                     [dict(params[0])]) == key
+    assert pyelastix._get_result_key(im2, im1, params) != key
+    assert pyelastix._get_result_key(im1, im2, params * 2) != key
+    assert pyelastix._get_result_key(im1, im2, params, (None, None),
+                                     'numpy') != key
+    params[0]['MaximumNumberOfIterations'] = 1
+    assert pyelastix._get_result_key(im1, im2, params) != key
+    with pytest.raises(ValueError):
+        pyelastix._get_result_key('/does/not/exist.mhd', im2, params)
+
+
+def test_result_cache(tmp_path, monkeypatch):
+    use_stub(monkeypatch)
+    params = pyelastix.get_default_params('AFFINE')
+    params.MaximumNumberOfIterations = 10
+    im1 = np.random.uniform(0, 1, (10, 12)).astype('float32')
+    im2 = np.zeros((10, 12), 'float32')
+
+    def register(im=im1, **kwargs):
+        report = pyelastix.RegistrationReport()
+        a, field = pyelastix.register(im, im2, params, verbose=0,
+                                      report=report, **kwargs)
+        return report.cached, a, field
+
+    pyelastix.set_result_cache(10 ** 6, str(tmp_path / 'cache'))
+    try:
+        cached, a1, field1 = register()
+        assert not cached
+        cached, a2, field2 = register(field_layout='stacked')
+        assert cached
+        assert (a2 == a1).all() and (a2 == im1).all()
+        assert all((field2[..., d] == field1[d]).all() for d in range(2))
+        # Another field engine gives another result
+        assert not register(field_engine='numpy')[0]
+        assert register(field_engine='numpy')[0]
+        # Rewriting an output directory does not change the cached result
+        out = str(tmp_path / 'out')
+        assert register(output_dir=out)[0]
+        assert not register(im1 + 1, output_dir=out)[0]
+        cached, a4, _ = register(output_dir=out)
+        assert cached and (a4 == im1).all()
+    finally:
+        pyelastix.set_result_cache(0)
+
+
+def test_transform_files(tmp_path):
+    text = ('(Transform "EulerTransform")\n'
+            '(NumberOfParameters 3)\n'
+            '(TransformParameters 0.1 -2 3.5)\n'
+            '(InitialTransformParametersFileName "NoInitialTransform")\n'
+            '(FinalBSplineInterpolationOrder 3)\n')
+    assert pyelastix._get_parameter(text, 'TransformParameters') == [0.1, -2,
+                                                                     3.5]
+    assert pyelastix._get_parameter(text, 'Transform') == ['EulerTransform']
+    assert pyelastix._get_parameter(text, 'Foo') is None
+    text2 = pyelastix._set_parameter(text, 'FinalBSplineInterpolationOrder', 0)
+    assert '(FinalBSplineInterpolationOrder 0)\n' in text2
+    text2 = pyelastix._set_parameter(text2, 'Foo', [1.0, True])
+    assert text2.endswith('(Foo 1.0 "true")\n')
+
+    # Save and load a chain of two transforms
+    t = pyelastix.Transform([text, text2])
+    t.save(str(tmp_path / 'transform.txt'))
+    t2 = pyelastix.Transform.from_file(str(tmp_path / 'transform.txt'))
+    assert repr(t2) == '<Transform EulerTransform with 2 stage(s)>'
+    assert t2.get_parameter('Foo') == [1.0, 'true']
+    assert t2.get_parameter('Foo', 0) is None
+    assert t2.get_parameter('InitialTransformParametersFileName') == [
+        str(tmp_path / 'transform_0.txt')]
+
+
+def test_transform_apply(monkeypatch):
+    use_stub(monkeypatch)
+    params = pyelastix.get_default_params('AFFINE')
+    params.MaximumNumberOfIterations = 10
+    im1 = np.random.uniform(0, 1, (10, 12)).astype('float32')
+    im2 = np.zeros((10, 12), 'float32')
+
+    # A chained transform, of which the workspace no longer exists
+    t0 = pyelastix.register(im1, im2, params, verbose=0,
+                            return_transform=True)[-1]
+    t = pyelastix.register(im1, im2, params, verbose=0,
+                           initial_transform=t0, return_transform=True)[-1]
+    assert len(t._texts) == 2
+    initial = t.get_parameter('InitialTransformParametersFileName')[0]
+    assert not os.path.isfile(initial)
+
+    labels = (im1 * 4).astype('uint8')
+    a, b, c = t.apply([im1, labels, labels > 1])
+    assert a.shape == b.shape == c.shape == im2.shape
+    assert a.dtype == np.float32 and (a == im1).all()
+    assert b.dtype == np.uint8 and (b == labels).all()
+    assert c.dtype == bool and (c == (labels > 1)).all()
+    assert (t.apply(im1) == a).all()
+
+
+def test_numpy_transform_evaluation():
+    grid = ('(Size 30 20)\n(Index 0 0)\n(Spacing 0.5 2.0)\n'
+            '(Origin 1.0 -3.0)\n(Direction 1 0 0 1)\n')
+
+    # Rotation of 90 degrees around (5, 5), followed by a translation
+    t = pyelastix.Transform('(Transform "EulerTransform")\n'
+                            '(TransformParameters %r 1.0 2.0)\n'
+                            '(CenterOfRotationPoint 5.0 5.0)\n'
+                            % (np.pi / 2) + grid)
+    assert t.can_evaluate()
+    points = t.transform_points([[6, 5], [5, 6]])
+    assert points == pytest.approx(np.array([[6, 8], [5, 7]]))
+    field = t.field(engine='numpy')
+    assert field[0].shape == (20, 30)
+    assert field[0][0, 0] == pytest.approx(13)
+    assert field[1][0, 0] == pytest.approx(6)
+
+    # B-spline with coefficients that increase linearly in x, which
+    # reproduces a linear function in the valid region of the grid
+    coefs = [float(i) for i in range(8)] * 6 + [0.0] * 48
+    b = pyelastix.Transform('(Transform "BSplineTransform")\n'
+                            '(TransformParameters %s)\n'
+                            '(GridSize 8 6)\n(GridIndex 0 0)\n'
+                            '(GridSpacing 2 2)\n(GridOrigin -4 -4)\n'
+                            '(GridDirection 1 0 0 1)\n'
+                            % ' '.join(map(str, coefs)) + grid)
+    points = np.array([[-2.0, -2.0], [3.3, 1.1], [5.0, 3.0], [20.0, 20.0]])
+    shift = b.transform_points(points) - points
+    assert shift[:, 0] == pytest.approx([1.0, 3.65, 4.5, 0.0])
+    assert shift[:, 1] == pytest.approx([0, 0, 0, 0])
+
+    # Sub-grid evaluation
+    full = b.field(engine='numpy')
+    region = (slice(None, None, 2), slice(3, None, 3))
+    sub = b.field(engine='numpy', region=region)
+    assert np.allclose(sub[0], full[0][region])
+
+    # Composition with an initial transform
+    c = pyelastix.Transform(['(Transform "TranslationTransform")\n'
+                             '(TransformParameters 1.0 0.0)\n' + grid,
+                             b._texts[0]])
+    assert c.transform_points([[3.3, 1.1]]) == pytest.approx(
+        np.array([[4.3 + 8.3 / 2, 1.1]]))
+
+
+def test_transform_points():
+    t = pyelastix.Transform('(Transform "TranslationTransform")\n'
+                            '(TransformParameters 1.0 -2.0)\n')
+    points = np.random.uniform(0, 100, (100000, 2))
+    result = pyelastix.transform_points(t, points)
+    assert result.shape == points.shape
+    assert np.allclose(result - points, [1.0, -2.0])
+    with pytest.raises(ValueError):
+        pyelastix.transform_points(t, points.ravel())
+
+
+def test_exes_cache(tmp_path, monkeypatch):
+    exe = tmp_path / 'elastix'
+    exe.write_text('')
+    (tmp_path / 'transformix').write_text('')
+    exe.chmod(0o755)
+    (tmp_path / 'transformix').chmod(0o755)
+    monkeypatch.setattr(pyelastix, '_get_exes_cache_file',
+                        lambda: str(tmp_path / 'exes.json'))
+    monkeypatch.setenv('ELASTIX_PATH', str(tmp_path))
+    monkeypatch.setattr(pyelastix, 'EXES', [])
+
+    assert pyelastix._load_exes_from_cache() is None
+    pyelastix.set_elastix_exes(str(exe))
+    pyelastix._save_exes_to_cache(pyelastix.EXES)
+    assert pyelastix._load_exes_from_cache() == [
+        str(exe), str(tmp_path / 'transformix')]
+    # Not valid if transformix is not executable, or if the cache file
+    # is owned by another user
+    if hasattr(os, 'getuid'):
+        (tmp_path / 'transformix').chmod(0o644)
+        assert pyelastix._load_exes_from_cache() is None
+        (tmp_path / 'transformix').chmod(0o755)
+        uid = os.getuid()
+        with monkeypatch.context() as m:
+            m.setattr(os, 'getuid', lambda: uid + 1)
+            assert pyelastix._load_exes_from_cache() is None
+        assert pyelastix._load_exes_from_cache() is not None
+    # Not valid for another ELASTIX_PATH
+    monkeypatch.setenv('ELASTIX_PATH', '')
+    assert pyelastix._load_exes_from_cache() is None
+
+    # Explicitly given executables skip the search
+    monkeypatch.setattr(pyelastix, 'EXES', [])
+    monkeypatch.setenv('ELASTIX_EXE', '/foo/elastix')
+    assert pyelastix.get_elastix_exes() == [
+        '/foo/elastix', os.path.join('/foo', 'transformix')]
+
+
+def test_workspace():
+    with pyelastix.Workspace() as ws1, pyelastix.Workspace() as ws2:
+        assert ws1.path != ws2.path
+        assert os.path.basename(ws1.path).startswith('id_%i_' % os.getpid())
+        path = pyelastix._write_image_data(np.zeros((4, 5), 'f4'), 1, ws1)
+        assert os.path.dirname(path) == ws1.path
+        ws1.clear()
+        assert os.listdir(ws1.path) == []
+    assert not os.path.isdir(ws1.path)
+
+    # The stale-dir scan runs once per process, in the background
+    janitor = pyelastix._janitor
+    assert janitor is not None
+    pyelastix._get_temproot()
+    assert pyelastix._janitor is janitor
+
+    # Each thread has its own default directory
+    dirs = []
+    t = threading.Thread(target=lambda: dirs.append(pyelastix.get_tempdir()))
+    t.start()
+    t.join()
+    assert dirs[0] != pyelastix.get_tempdir()
+
+    # The directories of a process are removed when it exits
+    code = ('import pyelastix; w = pyelastix.Workspace(); '
+            'open(w.path + "/f", "w").close(); print(w.path)')
+    path = subprocess.check_output([sys.executable, '-c', code],
+                                   cwd=os.path.dirname(pyelastix.__file__))
+    assert not os.path.isdir(path.decode().strip())
+
+
+def test_write_frames(tmp_path):
+    ims = [np.random.rand(6, 7).astype('float32') for i in range(5)]
+    first, frames = pyelastix._peek_frames(im for im in ims)
+    assert first is ims[0]
+    path = pyelastix._write_frames(frames, 1, str(tmp_path))
+    im = pyelastix._read_image_data(path, str(tmp_path))
+    assert im.shape == (5, 6, 7)
+    assert np.all(im == np.stack(ims))
+
+    with pytest.raises(ValueError):
+        pyelastix._write_frames([ims[0], ims[0][:3]], 1, str(tmp_path))
+    with pytest.raises(ValueError):
+        pyelastix._peek_frames(iter([]))
+    with pytest.raises(ValueError):
+        pyelastix._peek_frames(ims[0])
+
+
+def test_field_layouts():
+    b = pyelastix.Image(np.random.rand(6, 8, 2).astype('float32'))
+    b.sampling, b.origin = [2.0, 3.0, 1.0], [0.0, 0.0, 0]
+
+    x, y = pyelastix._split_fields(b, False)
+    assert x.base is not None and not x.flags.c_contiguous
+    assert np.all(x == b[:, :, 0]) and np.all(y == b[:, :, 1])
+    x, y = pyelastix._split_fields(b, False, 'contiguous')
+    assert x.flags.c_contiguous and np.all(y == b[:, :, 1])
+    stacked = pyelastix._split_fields(b, False, 'stacked')
+    assert np.shares_memory(stacked, b)
+
+    m = pyelastix._split_fields(b, False, 'magnitude', np.float16, 2)
+    assert m.shape == (3, 4) and m.dtype == np.float16
+    assert m.sampling == [4.0, 6.0]
+    expected = np.sqrt((b[::2, ::2] ** 2).sum(-1))
+    assert np.allclose(m, expected, atol=1e-2)
+
+    # Groupwise fields have a component for the extra dimension
+    b = np.random.rand(4, 6, 8, 3).astype('float32')
+    fields = pyelastix._split_fields(b, True, 'stacked')
+    assert len(fields) == 4 and fields[0].shape == (6, 8, 2)
+
+    with pytest.raises(ValueError):
+        pyelastix._get_field_kwargs('foo', None, 1)
+    with pytest.raises(ValueError):
+        pyelastix._get_field_kwargs('split', None, 1.5)
+
+
+def test_compression(tmp_path):
+    # Chunks compressed in parallel form a single valid zlib stream
+    data = np.random.randint(0, 3, 100000).astype('uint8').tobytes()
+    parts = pyelastix._compress_data(data, 6, chunk=30000)
+    assert len(parts) == 6
+    assert zlib.decompress(b''.join(parts)) == data
+
+    im = np.zeros((50, 60), 'int16')
+    im[10:20, 5:40] = 7
+    pyelastix.set_compression(6)
+    try:
+        path = pyelastix._write_image_data(im, 1, str(tmp_path))
+    finally:
+        pyelastix.set_compression(0)
+    assert (tmp_path / 'im1.zraw').stat().st_size < im.nbytes / 10
+    assert 'CompressedData = True' in open(path).read()
+    im2 = pyelastix._read_image_data(path, str(tmp_path), mmap=True)
+    assert im2.dtype == im.dtype and np.all(im2 == im)
+
+    with pytest.raises(ValueError):
+        pyelastix.set_compression(10)
+
+
+def test_registration_report(monkeypatch):
+    report = pyelastix.RegistrationReport()
+    with pyelastix._measure(report, 'write_images'):
+        pass
+    with pyelastix._measure(report, 'write_images'):
+        pass
+    assert list(report.times) == ['write_images']
+    assert report.total == report.times['write_images'] >= 0
+
+    # The hook is called also if the registration fails
+    reports = []
+    monkeypatch.setattr(pyelastix, '_report_hook', None)
+    pyelastix.set_report_hook(reports.append)
+    im = np.zeros((10, 10), 'float32')
+    with pytest.raises(ValueError):
+        pyelastix.register(im, im, pyelastix.get_default_params(),
+                           field_engine='foo')
+    assert len(reports) == 1 and isinstance(reports[0].error, ValueError)
+    assert 'params' in reports[0].times
+
+    # An error in the hook is a warning, and does not replace the error
+    pyelastix.set_report_hook(lambda report: 1 / 0)
+    with pytest.warns(UserWarning, match='ZeroDivisionError'):
+        with pytest.raises(ValueError):
+            pyelastix.register(im, im, pyelastix.get_default_params(),
+                               field_engine='foo')
+    pyelastix.set_report_hook(None)
+    with pytest.raises(TypeError):
+        pyelastix.set_report_hook(3)
+
+
+def test_early_stopping(tmp_path):
+    Event = pyelastix.ProgressEvent
+    policy = pyelastix.EarlyStopping(window=10, tolerance=0.01)
+    stopper = pyelastix._EarlyStopper(policy, str(tmp_path), 2)
+
+    # Earlier resolutions are ignored
+    for i in range(100):
+        assert not stopper(Event('iteration', 0, i, metric=1.0))
+
+    # The metric improves, then plateaus; stops after 2 windows of plateau
+    assert not stopper(Event('resolution', 1))
+    stopped = []
+    for i in range(100):
+        metric = -i if i < 30 else -30 + 0.001 * (i % 3)
+        if stopper(Event('iteration', 1, i, metric=metric)):
+            stopped.append(i)
+            break
+        fname = 'TransformParameters.0.R1.It%07i.txt' % i
+        (tmp_path / fname).write_text(str(i))
+    assert stopped == [40]
+    # Only the file of the best iteration (30) is kept
+    best = stopper.finish()
+    assert open(best).read() == '30'
+    assert len(list(tmp_path.iterdir())) == 1
+
+    # The last iteration may be only partly written, so if it is the best,
+    # the best one before it is used
+    outdir = tmp_path / 'out'
+    outdir.mkdir()
+    policy = pyelastix.EarlyStopping(window=0)
+    stopper = pyelastix._EarlyStopper(policy, str(outdir), 1)
+    for i in range(5):
+        assert not stopper(Event('iteration', 0, i, metric=-i))
+        fname = 'TransformParameters.0.R0.It%07i.txt' % i
+        (outdir / fname).write_text(str(i) if i < 4 else '(Tra')
+    assert open(stopper.finish()).read() == '3'
+    assert len(list(outdir.iterdir())) == 1
+
+    policy = pyelastix.EarlyStopping(max_time=0)
+    assert policy.update(Event('iteration', 3, 0, metric=1.0))
+
+
+def test_params_for_budget(tmp_path, monkeypatch):
+    # The cost model is stored per user, like the executables
+    assert os.path.dirname(pyelastix._get_cost_model_file()) == (
+        os.path.dirname(pyelastix._get_exes_cache_file()))
+
+    exe = tmp_path / 'elastix'
+    exe.write_text('')
+    monkeypatch.setattr(pyelastix, '_get_cost_model_file',
+                        lambda: str(tmp_path / 'costs.json'))
+    monkeypatch.setattr(pyelastix, 'EXES', [str(exe), 'transformix'])
+
+    # The cost model is stored per executable
+    assert pyelastix._load_cost_model('BSPLINE-2D') is None
+    model = {'start': 0.5, 'voxel': 1e-7, 'iteration': 1e-3,
+             'sample': 1e-6}
+    pyelastix._save_cost_model('BSPLINE-2D', model)
+    assert pyelastix._load_cost_model('BSPLINE-2D') == model
+    assert pyelastix._load_cost_model('AFFINE-2D') is None
+    if hasattr(os, 'getuid'):
+        uid = os.getuid()
+        with monkeypatch.context() as m:
+            m.setattr(os, 'getuid', lambda: uid + 1)
+            assert pyelastix._load_cost_model('BSPLINE-2D') is None
+
+    # Larger images get more resolutions, samples and a coarser grid (in
+    # voxels; the spacing is in physical units)
+    p1 = pyelastix.get_params_for_budget((128, 128), 'bspline', 30)
+    im = pyelastix.Image(np.zeros((1024, 1024), 'float32'))
+    im.sampling = (0.5, 0.5)
+    p2 = pyelastix.get_params_for_budget(im, 'bspline', 30)
+    assert p1.NumberOfResolutions == 4 and p2.NumberOfResolutions == 6
+    assert p1.NumberOfSpatialSamples < p2.NumberOfSpatialSamples
+    assert p1.FinalGridSpacingInPhysicalUnits == 16  # 16 voxels
+    assert p2.FinalGridSpacingInPhysicalUnits == 16  # 32 voxels of 0.5
+    assert p2.FinalGridSpacingInPhysicalUnits / 0.5 == 32
+    assert p1.MaximumNumberOfIterations == 2000
+
+    # A smaller budget means fewer iterations (and samples), within budget
+    p3 = pyelastix.get_params_for_budget((1024, 1024), 'bspline', 5)
+    assert p3.MaximumNumberOfIterations < p2.MaximumNumberOfIterations
+    assert p3.NumberOfSpatialSamples < p2.NumberOfSpatialSamples
+    n = p3.NumberOfResolutions
+    t = (0.5 + 1e-7 * 1024 ** 2 * n + n * p3.MaximumNumberOfIterations *
+         (1e-3 + 1e-6 * p3.NumberOfSpatialSamples))
+    assert 4 < t <= 5
+    with pytest.raises(ValueError):
+        pyelastix.get_params_for_budget((1024, 1024), 'bspline', 0.5)
+    with pytest.raises(ValueError):
+        pyelastix.get_params_for_budget((128, 128), 'foo', 10)
+
+
+def test_thread_budget(monkeypatch):
+    budget = pyelastix._ThreadBudget()
+    monkeypatch.setattr(pyelastix, '_thread_budget', budget)
+
+    # Without a budget, no limit is applied
+    monkeypatch.delenv('PYELASTIX_THREADS', raising=False)
+    monkeypatch.delenv('PYELASTIX_THREADS_PER_JOB', raising=False)
+    assert pyelastix.get_thread_budget() == (None, None)
+    assert budget.acquire() is None
+
+    # From the environment
+    budget.configured = False
+    monkeypatch.setenv('PYELASTIX_THREADS', '4')
+    monkeypatch.setenv('PYELASTIX_THREADS_PER_JOB', '2')
+    assert pyelastix.get_thread_budget() == (4, 2)
+
+    # The threads are passed to the process
+    args = []
+    monkeypatch.setattr(pyelastix, '_system3_now',
+                        lambda cmd, *rest: args.append(cmd[1:]))
+    pyelastix._system3(['elastix', '-out', 'foo'])
+    assert args == [['-out', 'foo', '-threads', '2']]
+    assert budget.acquire() == 2  # released again
+
+    # Jobs wait when the budget is used up
+    budget = pyelastix._ThreadBudget()
+    budget.configure(4, 2)
+    assert budget.acquire() == 2 and budget.acquire() == 2
+    acquired = []
+    t = threading.Thread(target=lambda: acquired.append(budget.acquire()))
+    t.start()
+    time.sleep(0.1)
+    assert not acquired
+    budget.release(2)
+    t.join(1)
+    assert acquired == [2]
+
+    with pytest.raises(ValueError):
+        pyelastix.set_thread_budget(0)
+
+    # Coroutines wait without polling, in turn with threads
+    budget = pyelastix._ThreadBudget()
+    budget.configure(2, 2)
+    assert budget.acquire() == 2
+    loop = asyncio.new_event_loop()
+    try:
+        task = loop.create_task(budget.acquire_async())
+        loop.run_until_complete(asyncio.sleep(0.01))
+        acquired = []
+        t = threading.Thread(target=lambda: acquired.append(budget.acquire()))
+        t.start()
+        time.sleep(0.1)
+        budget.release(2)
+        assert loop.run_until_complete(task) == 2
+        assert not acquired  # came after the coroutine
+        budget.release(2)
+        t.join(1)
+        assert acquired == [2]
+
+        # A cancelled coroutine takes no threads
+        task = loop.create_task(budget.acquire_async())
+        loop.run_until_complete(asyncio.sleep(0.01))
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            loop.run_until_complete(task)
+        budget.release(2)
+        assert budget.acquire(False) == 2
+    finally:
+        loop.close()
+
+
+def test_batch_cli(tmp_path, capsys):
+    manifest = tmp_path / 'manifest.csv'
+    manifest.write_text('id,moving,fixed\na,a1.mhd,a2.mhd\nb,b1.mhd,b2.mhd\n')
+    out = tmp_path / 'out'
+    db = str(out / 'jobs.sqlite')
+
+    # Jobs with missing images fail, after being retried
+    argv = ['batch', str(manifest), '--out', str(out), '--jobs', '2',
+            '--retries', '1', '--backoff', '0']
+    assert pyelastix.main(argv) == 1
+    assert '0 pending, 0 running, 0 done, 2 failed' in capsys.readouterr()[0]
+    store = pyelastix._JobStore(db)
+    assert [f[:2] for f in store.failures()] == [('a', 2), ('b', 2)]
+
+    # Done jobs are skipped, and jobs of a dead process are restarted
+    store._db.execute("UPDATE jobs SET state = 'done' WHERE id = 'a'")
+    p = subprocess.Popen([sys.executable, '-c', 'pass'])
+    p.wait()
+    store._db.execute("UPDATE jobs SET state = 'running', pid = ?, "
+                      "attempts = 0 WHERE id = 'b'", (p.pid, ))
+    store._db.commit()
+    store.close()
+    assert pyelastix.main(argv) == 1
+    lines = capsys.readouterr()[0].splitlines()
+    assert lines[0].startswith('retry   b:') and len(lines) == 3
+    assert pyelastix.main(['status', db]) == 1
+    assert '1 done, 1 failed' in capsys.readouterr()[0]
+
+    # Waiting for a retry does not spin, and the budget is restored
+    budget = pyelastix.get_thread_budget()
+    argv = ['batch', str(manifest), '--out', str(tmp_path / 'out2'),
+            '--retries', '1', '--backoff', '0.5']
+    t0, cpu0 = time.perf_counter(), time.process_time()
+    assert pyelastix.main(argv) == 1
+    assert time.perf_counter() - t0 > 0.5
+    assert time.process_time() - cpu0 < 0.25
+    assert pyelastix.get_thread_budget() == budget
+
+    # Ids cannot point outside the output directory
+    victim = tmp_path / 'victim'
+    victim.mkdir()
+    (victim / 'important.txt').write_text('')
+    for id in ('../victim', str(victim), '.', 'a/b'):
+        manifest.write_text('id,moving,fixed\n%s,a1.mhd,a2.mhd\n' % id)
+        with pytest.raises(SystemExit):
+            pyelastix.main(['batch', str(manifest), '--out', str(out)])
+    report, error = pyelastix._run_job('a1.mhd', 'a2.mhd', {},
+                                       str(out / '..' / 'victim'), str(out))
+    assert error.startswith('ValueError')
+    assert (victim / 'important.txt').exists()
+
+    assert pyelastix._parse_cli_param('A=1 2.5 true x') == (
+        'A', [1, 2.5, True, 'x'])
+    with pytest.raises(SystemExit):
+        pyelastix.main(['status', str(tmp_path / 'foo.sqlite')])
+
+
+def test_multi_stage_params(tmp_path, monkeypatch):
+    im = np.zeros((10, 10), 'float32')
+    stages = [pyelastix.get_default_params(t) for t in ('RIGID', 'BSPLINE')]
+    _, params = pyelastix._get_registration_params(im, im, stages, False)
+    assert [p['Transform'] for p in params] == ['EulerTransform',
+                                                'BSplineTransform']
+    assert params[0]['WriteResultImage'] is False
+    assert params[1]['WriteResultImage'] is True
+    with pytest.raises(ValueError):
+        pyelastix._get_registration_params([im, im], None, stages, False)
+
+    # One parameter file per stage, and the field of the last stage
+    monkeypatch.setattr(pyelastix, 'EXES', ['elastix', 'transformix'])
+    with pyelastix.Workspace() as workspace:
+        commands = pyelastix._prepare_registration(im, im, params, workspace)
+        p_files = [commands[0][i + 1] for i, arg in enumerate(commands[0])
+                   if arg == '-p']
+        assert [os.path.basename(f) for f in p_files] == ['params.0.txt',
+                                                          'params.1.txt']
+        assert commands[1][-1].endswith('TransformParameters.1.txt')
+
+    # The stage is reported in the progress events
+    parser = pyelastix._OutputParser()
+    assert parser.feed('Running elastix with parameter file 1: "p".\n') is None
+    assert parser.feed('Resolution: 0\n').stage == 1
+
+    # A chain can be loaded after its files were moved together
+    text = '(Transform "TranslationTransform")\n'
+    pyelastix._write_transform_files(
+        [text, text], [str(tmp_path / 'TransformParameters.0.txt'),
+                       str(tmp_path / 'TransformParameters.1.txt')])
+    target = tmp_path / 'moved'
+    pyelastix._copy_files(str(tmp_path), str(target),
+                          ['TransformParameters.0.txt',
+                           'TransformParameters.1.txt'])
+    (tmp_path / 'TransformParameters.0.txt').unlink()
+    t = pyelastix._get_transform(str(target), 1)
+    assert len(t._texts) == 2
+
+
+def test_register_sequence(monkeypatch):
+    params = pyelastix.get_default_params('AFFINE')
+    params.MaximumNumberOfIterations = [100, 200, 300, 400]
+    params.ImagePyramidSchedule = [8, 8, 4, 4, 2, 2, 1, 1]
+    warm = pyelastix._get_warm_params([params])
+    assert warm.NumberOfResolutions == 2
+    assert warm.MaximumNumberOfIterations == [150, 200]
+    assert warm.AutomaticTransformInitialization is False
+    assert not hasattr(warm, 'ImagePyramidSchedule')
+    assert params.NumberOfResolutions == 4
+
+    # Each frame starts from the previous transform, until the chain
+    # gets too long
+    calls = []
+
+    def register(im1, im2, params, initial_transform=None, **kwargs):
+        texts = initial_transform._texts if initial_transform else []
+        calls.append((im1, params.NumberOfResolutions, len(texts)))
+        return im1, None, pyelastix.Transform(texts + [''])
+
+    monkeypatch.setattr(pyelastix, 'register', register)
+    frames = (i for i in range(5))
+    results = list(pyelastix.register_sequence(frames, None, params,
+                                               max_chain=3))
+    assert [r[0] for r in results] == [0, 1, 2, 3, 4]
+    assert all(len(r) == 2 for r in results)
+    assert calls == [(0, 4, 0), (1, 2, 1), (2, 2, 2), (3, 4, 0), (4, 2, 1)]
+
+
+def test_masks(monkeypatch):
+    im = pyelastix.Image(np.zeros((10, 12), 'float32'))
+    im.sampling = (2.0, 1.0)
+    mask = np.zeros((10, 12), bool)
+    mask[2:8, 3:9] = True
+
+    # Masks are converted to uint8, with the sampling of the image
+    m = pyelastix._get_mask(mask, im, 'fixed_mask')
+    assert m.dtype == np.uint8 and m.sum() == 36
+    assert m.sampling == (2.0, 1.0)
+    m2 = pyelastix._get_mask(mask * 3.0, im, 'fixed_mask')
+    assert m2.dtype == np.uint8 and (m2 == m).all()
+    assert pyelastix._get_mask(None, im, 'fixed_mask') is None
+    with pytest.raises(ValueError):
+        pyelastix._get_mask(mask[1:], im, 'fixed_mask')
+    with pytest.raises(ValueError):
+        pyelastix._get_mask('/does/not/exist.mhd', im, 'fixed_mask')
+
+    # Written as MET_UCHAR images, and passed to Elastix
+    monkeypatch.setattr(pyelastix, 'EXES', ['elastix', 'transformix'])
+    _, params = pyelastix._get_registration_params(
+        im, im, pyelastix.get_default_params(), False)
+    with pyelastix.Workspace() as workspace:
+        commands = pyelastix._prepare_registration(
+            im, im, params, workspace, masks=(m, None))
+        command = commands[0]
+        assert '-mMask' not in command
+        path = command[command.index('-fMask') + 1]
+        assert 'MET_UCHAR' in open(path).read()
+        m3 = pyelastix._read_image_data(path, workspace.path)
+        assert (m3 == m).all() and m3.sampling == [2.0, 1.0]
+
+    # Masks are part of the key of the result cache
+    key = pyelastix._get_result_key(im, im, params)
+    assert pyelastix._get_result_key(im, im, params, (None, None)) == key
+    assert pyelastix._get_result_key(im, im, params, (m, None)) != key
+
+
+def test_register_tiled(monkeypatch):
+    # Neighbouring tiles overlap, and the weights sum to one
+    shape = (100, 70)
+    regions = pyelastix._get_tile_regions(shape, (40, 40), 10)
+    assert [r[0] for r in regions[::2]] == [slice(0, 40), slice(30, 70),
+                                            slice(60, 100)]
+    assert [r[1] for r in regions[:2]] == [slice(0, 40), slice(30, 70)]
+    total = np.zeros(shape)
+    for region in regions:
+        total[region] += pyelastix._get_tile_weights(region, shape, 10)
+    assert np.allclose(total, 1)
+
+    # Tiles know where they are, and the moving tile follows the transform
+    im = pyelastix.Image(np.zeros(shape, 'float32'))
+    im.sampling = (2.0, 1.0)
+    im.origin = (10.0, 0.0)
+    tile = pyelastix._get_tile(im, regions[3])
+    assert tile.origin == [70.0, 30.0] and tile.sampling == [2.0, 1.0]
+    text = ('(Transform "TranslationTransform")\n'
+            '(NumberOfParameters 2)\n(TransformParameters 5.0 4.0)\n')
+    transform = pyelastix.Transform(text)
+    moving = pyelastix._get_moving_tile(im, im, regions[3], 10, transform)
+    assert moving.shape == (40 + 20, 70 - 25)  # clipped at the border
+    assert moving.origin == [54.0, 25.0]
+
+    # The fields of the tiles are blended into one
+    def register_many(pairs, params, max_workers=None, **kwargs):
+        for i, (im1, im2) in enumerate(pairs):
+            field = np.ones(im2.shape + (2, ), 'float32')
+            yield i, (im2 + 1, field), None
+
+    monkeypatch.setattr(pyelastix, 'register_many', register_many)
+    a, field = pyelastix.register_tiled(im, im, {}, tile_size=40,
+                                        overlap=10, coarse_factor=None)
+    assert a.shape == shape and np.allclose(a, 1)
+    assert np.allclose(field[0], 1) and np.allclose(field[1], 1)
+    assert field[0].sampling == [2.0, 1.0] and a.origin == [10.0, 0.0]
+    # The files of the result are removed when it is no longer used
+    dirname = os.path.dirname(a.base.filename)
+    assert os.path.isfile(os.path.join(dirname, 'field.raw'))
+    del a
+    assert os.path.isdir(dirname)
+    del field
+    gc.collect()
+    assert not os.path.isdir(dirname)
+    with pytest.raises(ValueError):
+        pyelastix.register_tiled(im, im, {}, tile_size=40, overlap=30)
+    with pytest.raises(ValueError):
+        pyelastix.register_tiled(im[1:], im, {}, tile_size=40, overlap=10)
+    with pytest.raises(TypeError):
+        pyelastix.register_tiled(im, im, {}, tile_size=40, overlap=10,
+                                 field_layout='split')
+
+    # An initial transform is passed to the tiles
+    kwargs = []
+    monkeypatch.setattr(pyelastix, 'register_many',
+                        lambda *args, **kw: kwargs.append(kw) or [])
+    pyelastix.register_tiled(im, im, {}, tile_size=40, overlap=10,
+                             coarse_factor=None, initial_transform=transform)
+    assert kwargs[0]['initial_transform'] is transform